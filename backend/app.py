@@ -17,22 +17,37 @@ Final allows it to be run directly this way.
 """
 
 import os
+import time
+import uuid
+import shutil
+import json
+import tarfile
+import zipfile
 import datetime
 import threading
-import random
 from urllib import response
 
-import pickle
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor, wait
+
 from flask import Flask, render_template, request, flash, redirect, url_for, send_from_directory, jsonify
 from flask_cors import CORS, cross_origin
 from werkzeug.utils import secure_filename
 
 import main_script
 import createdicomfile
-import model
+import oar_config
 import image_prep
+import jobs
+import uploads
+import stream_ingest
+import result_cache
+import probability_store
+import z_gating
+import registry
+import workspaces
+import volume_store
 # main_script handles all deep learning backend functions
 
 # ==== Define settings referenced throughout the app ====
@@ -40,130 +55,641 @@ app = Flask(__name__)
 CORS(app,origins=['http://localhost:3000'],methods=['GET','POST','OPTIONS','PUT','DELETE'],send_wildcard=True)
 app.config['CORS_HEADERS'] = 'Content-Type'
 app.secret_key = 'jessalee'
-UPLOAD_FOLDER = app.root_path + '\\uploadfiles'
-OUTPUT_FOLDER = app.root_path +'\\generatedfiles'
 TODAY = datetime.date.today()
 ALLOWED_EXTENSIONS = {'dcm'}
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
-
-threads = {}
+app.config['WORKSPACE_ROOT'] = os.path.join(app.root_path,'jobfiles') # each job gets its own upload/output folders under here
+app.config['WORKSPACE_RETENTION'] = 24*3600 # seconds an idle workspace is kept before garbage collection
+app.config['WORKSPACE_QUOTA'] = 20*1024**3 # bytes all workspaces may use before the oldest idle ones are removed
+app.config['UPLOAD_MAX_SIZE'] = 512*1024**2 # bytes a single file sent through /api/uploads may declare
+app.config['MAX_CONTENT_LENGTH'] = 1024**3 # bytes a request body may hold, larger requests get 413; also caps a zip sent to /api/files/archive, which is held in memory
+app.config['WORKSPACE_GC_INTERVAL'] = 300 # seconds between garbage collection runs of the workspaces, done on a background thread
+app.config['INFERENCE_BACKEND'] = os.environ.get('INFERENCE_BACKEND','keras') # 'keras', 'onnx' (ONNX Runtime on CPU, see onnx_backend.py) or 'onnx_int8' (quantized models, installed by training/quantization.py)
+app.config['INFERENCE_ENGINE'] = 'combined' # 'combined' runs all OARs in one forward pass, 'sequential' runs them one at a time (Keras only)
+# memory: 'combined' holds every OAR's map at once as uint8, 1 byte per voxel and OAR. Only 'sequential' keeps to one float32 map plus the POSTPROCESS_WORKERS + 1 waiting for contouring
+app.config['JOB_WORKERS'] = 2 # number of jobs (ingest -> inference -> RTSTRUCT) that run at the same time
+app.config['JOB_QUEUE_LIMIT'] = 16 # number of jobs allowed to wait for a worker before submissions are refused
+app.config['RESULT_CACHE_FOLDER'] = os.path.join(app.root_path,'resultcache') # structure sets keyed by content hash of the series, weights and thresholds
+app.config['RESULT_CACHE_BUDGET'] = 2*1024**3 # bytes the result cache may use before least recently used entries are removed
+app.config['CONTOUR_THRESHOLD'] = 0.33 # probability above which a voxel belongs to the OAR, passed to create_dicom
+app.config['BODY_MASK'] = True # skip slices with no patient tissue and clear predictions outside the body's bounding box
+app.config['Z_GATING'] = True # coarse pass per OAR, then predict only the candidate slab (see z_gating.py). Sequential engine only, no effect with 'combined', which predicts every slice
+#off until its cochlea contours are shown to match full-frame inference (Dice) on clinical scans
+app.config['POSTPROCESS_WORKERS'] = 2 # threads that threshold, clean up and contour OARs while the next OAR is predicted
+app.config['REGISTRY_SIZE'] = 256 # maximum number of threads/jobs held for progress queries
+app.config['REGISTRY_TTL'] = 3600 # seconds a finished thread/job stays queryable before it is evicted
+
+postprocess_pool = ThreadPoolExecutor(max_workers=app.config['POSTPROCESS_WORKERS'],thread_name_prefix='postprocess') #shared by all jobs
+PROBABILITY_MAPS = 'probability_maps.npz' # uint8 quantized network outputs of the workspace, see probability_store.py
+
+threads = registry.Registry(app.config['REGISTRY_SIZE'],app.config['REGISTRY_TTL'])
+job_queue = jobs.JobQueue(app.config['JOB_WORKERS'],app.config['JOB_QUEUE_LIMIT'],app.config['REGISTRY_SIZE'],app.config['REGISTRY_TTL'])
+upload_manager = uploads.UploadManager(app.config['UPLOAD_MAX_SIZE'])
+workspace_manager = workspaces.WorkspaceManager(app.config['WORKSPACE_ROOT'],app.config['WORKSPACE_RETENTION'],app.config['WORKSPACE_QUOTA'])
+results = result_cache.ResultCache(app.config['RESULT_CACHE_FOLDER'],app.config['RESULT_CACHE_BUDGET']) #structure sets and their probability maps, one budget
+ingests = {} #workspace ID -> stream_ingest.StreamingIngest fed by the upload endpoints
+ingest_lock = threading.Lock()
+
+def workspace_ingest(workspace):
+    with ingest_lock:
+        if workspace.id not in ingests:
+            ingests[workspace.id] = stream_ingest.StreamingIngest(workspace.upload_folder,workspace.output_folder)
+        return ingests[workspace.id]
+
+def drop_ingest(workspace_id):
+    with ingest_lock:
+        ingests.pop(workspace_id,None)
+
+def ingest_workspace(workspace,series_uid=None):
+    """
+    Builds the patient volume of workspace. Slices decoded while they were uploaded are
+    used when they cover every file in the upload folder, otherwise the folder is decoded
+    from scratch with main_script.validate_files. series_uid picks the series when the
+    upload holds more than one.
+    """
+    with ingest_lock:
+        ingest = ingests.get(workspace.id)
+    if ingest is not None and ingest.covers_folder():
+        message = ingest.finish(series_uid)
+        drop_ingest(workspace.id) #finish released the decoded slices, files uploaded later start a new ingest
+        return message
+    return main_script.validate_files(workspace.upload_folder,workspace.output_folder,series_uid)
+
+def volume_is_current(workspace,series_uid=None):
+    """
+    True if the workspace holds a patient volume built after every file in its upload
+    folder, e.g. by /api/files/validate or /api/files/archive, and of series_uid if given.
+    """
+    volume_path = os.path.join(workspace.output_folder,'patient_volume.vol')
+    if not os.path.exists(volume_path):
+        return False
+    built = os.path.getmtime(volume_path)
+    if any(os.path.getmtime(filepath) > built for filepath in stream_ingest.list_dicom_files(workspace.upload_folder)):
+        return False
+    return series_uid is None or volume_store.read_header(volume_path)['series_uids'].get('SeriesInstanceUID') == series_uid
+
+workspace_manager.on_delete.append(drop_ingest) #decoded slices are released together with the workspace files
+
+# ==== Build the model once and hold every OAR's weights in memory before serving ====
+bank = None
+engine = None
+
+def start_services():
+    """
+    Loads and warms up the models and starts the workspace collector.
+    Backends are imported here so that the ONNX Runtime process never loads TensorFlow.
+    """
+    global bank, engine
+    workspace_manager.start_collector(app.config['WORKSPACE_GC_INTERVAL'])
+    if app.config['INFERENCE_BACKEND'] in ('onnx','onnx_int8'):
+        import onnx_backend
+        bank = onnx_backend.OnnxModelBank(onnxfolder=os.path.join(app.root_path,'weights',app.config['INFERENCE_BACKEND']))
+        bank.warmup()
+        app.config['INFERENCE_ENGINE'] = 'sequential'
+    else:
+        import model_bank
+        bank = model_bank.ModelBank(weightsfolder=os.path.join(app.root_path,'weights'))
+        bank.warmup()
+        engine = model_bank.MultiOARModel(bank)
+        engine.warmup()
+
+#with python app.py, spawned ingest workers (image_prep.get_process_pool) import this file again as __mp_main__,
+#they must not load the models or start threads
+if __name__ != '__mp_main__':
+    start_services()
 
 
 class UploadThread(threading.Thread):
     def __init__(self):
         self.progress = 0
+        self.started = None
+        self.finished = None
         super().__init__()
     
-    def run(self,request):
+    def run(self,request,workspace):
         files = request.files
         files_processed = 0
-        for k,file in files.items():
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'],filename))
-            files_processed += 1
-            self.progress = int((files_processed / len(files)) * 100)
-            app.logger.info("Files {} percent uploaded".format(self.progress))
+        self.started = time.time()
+        workspace_manager.acquire(workspace) #keeps the workspace from being collected mid-upload
+        try:
+            for k,file in files.items():
+                filename = secure_filename(file.filename)
+                file.save(os.path.join(workspace.upload_folder,filename))
+                workspace_ingest(workspace).add_file(os.path.join(workspace.upload_folder,filename)) #decoding runs while the client sends its next request
+                files_processed += 1
+                self.progress = int((files_processed / len(files)) * 100)
+                app.logger.info("Files {} percent uploaded".format(self.progress))
+        finally:
+            workspace_manager.release(workspace)
+            self.finished = time.time() #lets the registry evict the thread once its TTL has passed
+
+def generate_structure_set(tracker,workspace):
+    """
+    Runs every OAR on the patient volume ingested into workspace and writes the RTSTRUCT
+    file there. tracker is any object with progress and stage attributes (CNNThread or
+    jobs.Job), it is updated as the work advances. Returns the ID of the structure set file.
+    """
+    OARs = oar_config.OARS
+    genfilesfolder = workspace.output_folder
+
+    image_size = 256
+
+    SS_fileID = uuid.uuid4().hex
+    SS_path = os.path.join(genfilesfolder,'RS.CNN_created.{}.dcm'.format(SS_fileID))
+    volume_path = os.path.join(genfilesfolder,'patient_volume.vol')
+    record_path = os.path.join(genfilesfolder,'series_metadata.json')
+    cache_params = {'image_size':image_size,'threshold':app.config['CONTOUR_THRESHOLD'],
+                    'engine':app.config['INFERENCE_ENGINE'],'OARs':OARs,
+                    'body_mask':app.config['BODY_MASK'],'z_gating':app.config['Z_GATING']}
+    cache_key = result_cache.cache_key(volume_path,record_path,bank.fingerprint(),cache_params)
+    maps_path = os.path.join(genfilesfolder,PROBABILITY_MAPS)
+    cached = results.get(cache_key)
+    if cached is not None:
+        try:
+            createdicomfile.reissue_structure_set(cached['.dcm'],SS_path) #same contours, but a new instance UID for every request
+            if '.npz' in cached:
+                shutil.copyfile(cached['.npz'],maps_path) #keeps /api/recontour available for the repeat study
+            elif os.path.exists(maps_path):
+                os.remove(maps_path) #maps of an earlier study must not be recontoured into this one
+            tracker.set_stage('cache','Identical study already processed. Structure set file ready for download.')
+            return SS_fileID
+        except FileNotFoundError:
+            pass #evicted between lookup and copy, compute it again
+
+    tracker.set_stage('inference','Loading patient volume...')
+    patient_volume, volume_header = volume_store.load_volume(volume_path)
+    heightlist = volume_header["heightlist"]
+    num_slices = len(patient_volume)
+    if app.config['BODY_MASK']:
+        body_slices, body_box = image_prep.body_extent(patient_volume) #air and couch above the vertex or below the shoulders never reach the network
+    else:
+        body_slices, body_box = slice(0,num_slices), (0,image_size,0,image_size)
+    body_volume = patient_volume[body_slices]
+    app.logger.info("Body found on {} of {} slices.".format(len(body_volume),num_slices))
+
+    windows = image_prep.WindowCache(body_volume,oar_config.FILTERS) #each window is computed once and shared by the OARs that use it
+    maps = probability_store.MapWriter(maps_path,heightlist)
+    contour_futures = [] #only contour coordinates are kept, each probability map is released once it is contoured
+    in_flight = threading.BoundedSemaphore(app.config['POSTPROCESS_WORKERS'] + 1) #caps the maps waiting for contouring, so memory stays bounded
+
+    def contour_task(OAR,prediction,gated):
+        prediction = image_prep.restore_extent(prediction,body_slices,body_box,num_slices)
+        maps.add(OAR,prediction,gated)
+        if prediction.dtype == np.uint8: #combined engine, maps arrive quantized
+            prediction = probability_store.dequantize(prediction)
+        return [OAR,createdicomfile.contour_roi(OAR,prediction,heightlist,image_size,app.config['CONTOUR_THRESHOLD'])]
+
+    def contour(OAR,prediction,gated=False):
+        #post-processing of this OAR runs on the pool while the next OAR is predicted
+        in_flight.acquire()
+        future = postprocess_pool.submit(contour_task,OAR,prediction,gated)
+        future.add_done_callback(lambda f: in_flight.release())
+        contour_futures.append(future)
+
+    try:
+        if app.config['INFERENCE_ENGINE'] == 'combined':
+            tracker.progress = 'Working on all OARs...'
+            report = InferenceProgress(tracker,['all'],len(body_volume))
+            predictions = engine.predict(windows,progress=report.callback(0)) #one forward pass returns every OAR's map, quantized to uint8
+            for OAR in OARs:
+                contour(OAR,predictions.pop(OAR))
+        else:
+            report = InferenceProgress(tracker,OARs,len(body_volume))
+            slicethickness = volume_header["spacing"][2]
+            margin = int(np.ceil(z_gating.MARGIN_MM / slicethickness)) if slicethickness > 0 else 0
+            for i,OAR in enumerate(OARs):
+                tracker.progress = 'Working on {} ({} of {})...'.format(OAR,i+1,len(OARs))
+                filtered_patient_volume = windows.get(oar_config.OAR_WINDOWS[OAR])
+                stride = z_gating.gating_stride(OAR,slicethickness) if app.config['Z_GATING'] else 1
+                predict = lambda slices,progress,OAR=OAR: bank.predict(OAR,slices,progress=progress) #weights are already resident, this only swaps arrays
+                prediction, passes = z_gating.gated_predict(predict,filtered_patient_volume,stride,margin,report.callback(i))
+                app.logger.info("{}: {} of {} slices predicted.".format(OAR,passes,num_slices))
+                contour(OAR,prediction,passes < len(filtered_patient_volume)) #skipped slices make the map gated, see /api/recontour
+
+        tracker.set_stage('rtstruct','All OARs complete. Building structure set...')
+        contourdata = [future.result() for future in contour_futures] #keeps the OAR order of the structure set
+        maps.close()
+    except Exception:
+        for future in contour_futures:
+            future.cancel()
+        wait(contour_futures) #tasks already running may still be adding maps
+        maps.discard() #drops the partial file, /api/recontour keeps the previous maps
+        raise
+    patient_data,UIDdict = createdicomfile.load_series_record(record_path)
+    structure_set = createdicomfile.assemble_structure_set(patient_data,UIDdict,contourdata)
+    structure_set.save_as(SS_path, write_like_original=False)
+    results.put(cache_key,{'.dcm':SS_path,'.npz':maps_path})
+    tracker.progress = 'All OARs complete. Structure set file ready for download.'
+    return SS_fileID
+
+def recontour_structure_set(workspace,threshold,postprocess=None):
+    """
+    Rebuilds the RTSTRUCT of workspace from the stored probability maps with new
+    thresholds and post-processing flags, without calling the network.
+    Returns the ID of the new structure set file.
+    """
+    genfilesfolder = workspace.output_folder
+    maps_path = os.path.join(genfilesfolder,PROBABILITY_MAPS)
+    heightlist = probability_store.load_heightlist(maps_path)
+    contourdata = []
+    for OAR,prediction in probability_store.iter_maps(maps_path): #one map in memory at a time
+        contourdata.append([OAR,createdicomfile.contour_roi(OAR,prediction,heightlist,256,threshold,postprocess)])
+    patient_data,UIDdict = createdicomfile.load_series_record(os.path.join(genfilesfolder,'series_metadata.json'))
+    structure_set = createdicomfile.assemble_structure_set(patient_data,UIDdict,contourdata)
+    SS_fileID = uuid.uuid4().hex
+    structure_set.save_as(os.path.join(genfilesfolder,'RS.CNN_created.{}.dcm'.format(SS_fileID)), write_like_original=False)
+    return SS_fileID
+
+class InferenceProgress:
+    """
+    Turns per-batch slice counts from the inference backends into progress events
+    on tracker, with the OAR being worked on and an ETA for the whole inference stage.
+    """
+    def __init__(self, tracker, OARs, num_slices):
+        self.tracker = tracker
+        self.OARs = OARs
+        self.num_slices = num_slices
+        self.total = len(OARs) * num_slices
+        self.start = time.time()
+
+    def callback(self, OAR_index):
+        return lambda slices_done: self.report(OAR_index,slices_done)
+
+    def report(self, OAR_index, slices_done):
+        done = OAR_index * self.num_slices + slices_done
+        elapsed = time.time() - self.start
+        eta = elapsed / done * (self.total - done) if done > 0 else None
+        self.tracker.emit('progress',OAR=self.OARs[OAR_index],OAR_index=OAR_index,OAR_count=len(self.OARs),
+                          slices_done=slices_done,slice_count=self.num_slices,eta=eta)
+
+def structure_set_result(workspace,SS_fileID):
+    return {'workspace_id':workspace.id,'file_id':SS_fileID,
+            'download':'/api/files/download?workspace_id={}&file_id={}'.format(workspace.id,SS_fileID)}
+
+def run_inference_job(job,workspace):
+    try:
+        return structure_set_result(workspace,generate_structure_set(job,workspace))
+    finally:
+        workspace_manager.finish_job(workspace)
+
+def run_pipeline_job(job,workspace,series_uid=None):
+    try:
+        job.set_stage('ingest','Processing uploaded DICOM files...')
+        if not volume_is_current(workspace,series_uid): #archives leave the upload folder empty, validated uploads are not decoded twice
+            ingest_workspace(workspace,series_uid)
+        return structure_set_result(workspace,generate_structure_set(job,workspace))
+    finally:
+        workspace_manager.finish_job(workspace)
+
+def request_workspace():
+    """
+    Workspace named by the workspace_id query argument. Requests without one use the
+    shared 'default' workspace, which keeps single-user scripts working unchanged; the
+    frontend creates a workspace of its own on page load (services/workspace.js).
+    Returns None for unknown IDs.
+    """
+    workspace_id = request.args.get('workspace_id','default')
+    if workspace_id == 'default':
+        return workspace_manager.create('default')
+    return workspace_manager.get(workspace_id)
+
+def workspace_busy():
+    return app.response_class(status=409,response="Workspace already has a running job.")
+
+def submit_workspace_job(kind,fn,*args):
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    if not workspace_manager.start_job(workspace): #finished by the job itself
+        return workspace_busy()
+    try:
+        job = job_queue.submit(kind,fn,workspace,*args)
+    except jobs.QueueFull as e:
+        workspace_manager.finish_job(workspace)
+        return app.response_class(status=503,response=str(e))
+    return job
 
 class CNNThread(threading.Thread):
     def __init__(self):
         self.progress = ""
+        self.stage = None
+        self.started = None
+        self.finished = None
+        self.last_event = None
         super().__init__()
 
-    def generate_ss(self):
-        OARs = ['Brainstem', 'Cochlea L','Cochlea R','Parotid L','Parotid R',
-                'Submandibular L','Submandibular R','Brachial Plexus',
-                'Brain','Larynx','Spinal Cord']
-        imagefolder = app.config['UPLOAD_FOLDER']
-        genfilesfolder = app.config['OUTPUT_FOLDER']
-
-        image_size = 256
-
-        patient_volume = np.load(os.path.join(genfilesfolder,'patient_volume.npy'))
-        with open(os.path.join(genfilesfolder,'slice_height_map.pckl'), 'rb') as pickle_file:
-            heightlist = pickle.load(pickle_file)
-
-        filters = {"bone":[2000, 400], "tissue":[400,40],"none":[4500,1000]}
-        neuralnet = model.get_unet(image_size)
-        structuresetdata = []
-        for i,OAR in enumerate(OARs):
-            self.progress = '\n'.join(['{} complete.'.format(OARs[j]) for j in range(i)]) + '\nWorking on {}...'.format(OAR)
-            if any((OAR == 'Spinal Cord', OAR == 'Brachial Plexus')):
-                filter = filters['bone']
-            else:
-                filter = filters['tissue']
-
-            neuralnet.load_weights(os.path.join('weights','{}.hdf5'.format(OAR.replace(" ",""))))
-
-            filtered_patient_volume = image_prep.apply_window_level(patient_volume,filter[0],filter[1])
-            prediction = neuralnet.predict(filtered_patient_volume,verbose=0)
-            structuresetdata.append([OAR,prediction,heightlist]) #list of OAR name, prediction array (not yet binarized, this will happen in the create_dicom function), and the previously created height list map
-
-        self.progress = '\n'.join(['{} complete.'.format(OARs[j]) for j in range(len(OARs))]) + '\nAll OARs complete. Structure set file ready for download.'
-        patient_data,UIDdict = createdicomfile.gather_patient_data(imagefolder)
-        structure_set = createdicomfile.create_dicom(patient_data,UIDdict,structuresetdata,image_size=image_size)
-        SS_fileID = str(random.randint(0,10000))
-        structure_set.save_as(os.path.join(app.config['OUTPUT_FOLDER'],'RS.CNN_created.{}.dcm'.format(SS_fileID)), write_like_original=False)
-        return SS_fileID
+    def set_stage(self,stage,progress=''):
+        self.stage = stage
+        self.progress = progress
+
+    def emit(self,event,**fields):
+        self.last_event = fields #only jobs stream events, threads keep the latest for polling
+
+    def generate_ss(self,workspace):
+        return generate_structure_set(self,workspace)
+
+@app.route('/api/ready', methods=['GET'])
+def check_ready():
+    if bank.ready and (engine is None or engine.ready):
+        return app.response_class(status=200,response="Models loaded and warmed up.")
+    return app.response_class(status=503,response="Models still loading.")
 
 @app.route('/api/threads/create', methods=['GET'])
 def instantiate_thread():
     global threads
-    thread_id = str(random.randint(0,10000))
-    if request.args.get('threadtype') == 'upload':
-        threads[thread_id] = UploadThread()
-        return thread_id
-    if request.args.get('threadtype') == 'neural':
-        threads[thread_id] = CNNThread()
-        return thread_id
+    try:
+        if request.args.get('threadtype') == 'upload':
+            return threads.add(UploadThread())
+        if request.args.get('threadtype') == 'neural':
+            return threads.add(CNNThread())
+    except registry.RegistryFull as e:
+        return app.response_class(status=503,response=str(e))
+
+@app.route('/api/workspaces', methods=['POST'])
+def create_workspace():
+    workspace = workspace_manager.create()
+    return jsonify({'workspace_id':workspace.id}), 201
+
+@app.route('/api/workspaces/<workspace_id>', methods=['GET','DELETE'])
+def workspace_status(workspace_id):
+    workspace = workspace_manager.get(workspace_id)
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    if request.method == 'GET':
+        return jsonify({'workspace_id':workspace.id,
+                        'files':os.listdir(workspace.upload_folder),
+                        'outputs':os.listdir(workspace.output_folder),
+                        'active_jobs':workspace.active,
+                        'last_used':workspace.last_used,
+                        'disk_usage':workspace.disk_usage()})
+    if not workspace_manager.delete(workspace_id):
+        return app.response_class(status=409,response="Workspace has a running job.")
+    return app.response_class(status=200,response="Workspace deleted.")
 
 @app.route('/api/files', methods=['GET','POST'])
 def files():
     global threads
 
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
     if request.method == 'GET':
-        file_list = os.listdir(app.config['UPLOAD_FOLDER'])
+        file_list = os.listdir(workspace.upload_folder)
         return jsonify({'files':file_list})
     if request.method == 'POST':
         app.logger.info(request)
-        thread_id = request.args.get('thread_id')
-        threads[thread_id].run(request)
+        upload = threads.get(request.args.get('thread_id'))
+        if not isinstance(upload,UploadThread): #same check as /api/inference, other registry entries cannot take files
+            return app.response_class(status=404,response="Unknown thread ID.")
+        upload.run(request,workspace)
         return app.response_class(status=201,response="files saved")
 
+@app.route('/api/files/archive', methods=['POST'])
+def upload_archive():
+    """
+    Accepts a zip or tar archive of the study, either as the raw request body or as
+    the first file of a multipart form, and ingests it straight from the stream.
+    Replaces the patient volume of the workspace; the upload folder is not used, a
+    following /api/jobs request runs on the ingested volume.
+    Only a raw body is streamed without touching the disk: werkzeug spools a
+    multipart upload to a temporary file before the form can be parsed.
+    """
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return app.response_class(status=413,response="Archive is larger than {} bytes.".format(app.config['MAX_CONTENT_LENGTH']))
+    if not workspace_manager.start_job(workspace):
+        return workspace_busy()
+    try:
+        stream = next(iter(request.files.values())).stream if len(request.files) > 0 else request.stream
+        ingest = stream_ingest.StreamingIngest(None,workspace.output_folder)
+        for name, data in stream_ingest.iter_archive(stream,app.config['MAX_CONTENT_LENGTH']):
+            ingest.add_bytes(name,data) #decoding of this member overlaps reading the next
+        message = ingest.finish(request.args.get('series_uid'))
+    except stream_ingest.ArchiveTooLarge as e:
+        return app.response_class(status=413,response=str(e))
+    except (tarfile.TarError,zipfile.BadZipFile,ValueError) as e:
+        return app.response_class(status=400,response="Could not read archive: {}".format(e))
+    finally:
+        workspace_manager.finish_job(workspace)
+    return app.response_class(status=200,response=message)
+
+@app.route('/api/uploads/<filename>', methods=['GET','PUT'])
+def chunked_upload(filename):
+    """
+    Chunked, resumable upload of a single file, see uploads.py for the protocol.
+    """
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    filename = secure_filename(filename)
+    if filename == '':
+        return app.response_class(status=400,response="Invalid file name.")
+    workspace_manager.acquire(workspace)
+    try:
+        if request.method == 'GET':
+            session = upload_manager.session(workspace,filename)
+            if session is None:
+                filepath = os.path.join(workspace.upload_folder,filename)
+                if os.path.exists(filepath): #already completed
+                    size = os.path.getsize(filepath)
+                    return jsonify({'size':size,'received':size,'complete':True})
+                return jsonify({'size':None,'received':0,'complete':False})
+            return jsonify(session.status())
+        offset = request.args.get('offset',0,type=int)
+        size = request.args.get('size',type=int)
+        status = upload_manager.write_chunk(workspace,filename,offset,size,request.get_data(cache=False),
+                                            request.headers.get('X-Chunk-SHA256'))
+        return jsonify(status)
+    except uploads.FileTooLarge as e:
+        return app.response_class(status=413,response=str(e))
+    except uploads.ChunkError as e:
+        return app.response_class(status=409,response=str(e))
+    finally:
+        workspace_manager.release(workspace)
+
+@app.route('/api/uploads/<filename>/complete', methods=['POST'])
+def complete_upload(filename):
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    filename = secure_filename(filename)
+    if filename == '':
+        return app.response_class(status=400,response="Invalid file name.")
+    workspace_manager.acquire(workspace)
+    try:
+        status = upload_manager.finish(workspace,filename,request.args.get('sha256'))
+        workspace_ingest(workspace).add_file(os.path.join(workspace.upload_folder,filename))
+        return jsonify(status)
+    except uploads.ChunkError as e:
+        return app.response_class(status=409,response=str(e))
+    finally:
+        workspace_manager.release(workspace)
+
 @app.route('/api/files/download',methods=['GET'])
 def download_ss():
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
     file_id = request.args.get('file_id')
     filename = "RS.CNN_created.{}.dcm".format(file_id)
-    return send_from_directory(app.config['OUTPUT_FOLDER'],filename,as_attachment=True,mimetype='application/dicom')
+    return send_from_directory(workspace.output_folder,filename,as_attachment=True,mimetype='application/dicom')
 
 
 @app.route('/api/threads/<thread_id>/progress', methods=['GET'])
 def check_progress(thread_id):
     global threads
-    return str(threads[thread_id].progress)
+    thread = threads.get(thread_id)
+    if thread is None:
+        return app.response_class(status=404,response="Unknown thread ID.")
+    return str(thread.progress)
 
 @app.route('/api/files/validate', methods=['GET'])
 def validate_files():
     if request.method == 'GET':
-        message = main_script.validate_files(app.config['UPLOAD_FOLDER'],app.config['OUTPUT_FOLDER'])
+        workspace = request_workspace()
+        if workspace is None:
+            return app.response_class(status=404,response="Unknown workspace ID.")
+        if not workspace_manager.start_job(workspace): #also keeps garbage collection away while the volume is written
+            return workspace_busy()
+        try:
+            message = ingest_workspace(workspace,request.args.get('series_uid'))
+        except ValueError as e: #several series and none picked, or unknown series
+            return app.response_class(status=400,response=str(e))
+        finally:
+            workspace_manager.finish_job(workspace)
     return app.response_class(status=200,response=message)
 
+@app.route('/api/series', methods=['GET'])
+def list_series():
+    """
+    Lists the CT series in the workspace upload folder from a single header pass,
+    so the client can pick one with the series_uid argument of validate or jobs.
+    """
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    workspace_manager.acquire(workspace)
+    try:
+        index = image_prep.index_series(image_prep.scan_headers(workspace.upload_folder))
+    finally:
+        workspace_manager.release(workspace)
+    return jsonify({'series':image_prep.describe_series(index)})
+
 @app.route('/api/inference',methods=['GET'])
 def create_structure_set():
     global threads
 
     thread_id = request.args.get('thread_id')
-    file_id = threads[thread_id].generate_ss()
-    return file_id
+    if thread_id is not None and not isinstance(threads.get(thread_id),CNNThread): #only IDs from /api/threads/create, never another client's job
+        return app.response_class(status=404,response="Unknown thread ID.")
+    job = submit_workspace_job('inference',run_inference_job)
+    if not isinstance(job,jobs.Job):
+        return job #error response
+    if thread_id is not None and not threads.replace(thread_id,job): #keeps /api/threads/<id>/progress working for the submitted job
+        app.logger.warning("Thread {} expired before job {} could take its place.".format(thread_id,job.id))
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/recontour', methods=['POST'])
+def recontour():
+    """
+    Regenerates the structure set of a workspace from its stored probability maps.
+    JSON body: {"thresholds": 0.4 or {"Parotid L": 0.4, ...},
+                "postprocess": {"height_prior": bool, "scrap_stray": bool, "z_smoothing": bool}}
+    Both keys are optional. Thresholds lie between 0 and 1. OARs whose map was z-gated
+    need at least z_gating.COARSE_THRESHOLD: the map is zero outside the slab the coarse
+    pass found at that threshold. Returns the same result as a finished job.
+    """
+    workspace = request_workspace()
+    if workspace is None:
+        return app.response_class(status=404,response="Unknown workspace ID.")
+    if not os.path.exists(os.path.join(workspace.output_folder,PROBABILITY_MAPS)):
+        return app.response_class(status=409,response="No probability maps stored for this workspace, run inference first.")
+    body = request.get_json(silent=True) or {}
+    threshold = body.get('thresholds',app.config['CONTOUR_THRESHOLD'])
+    postprocess = body.get('postprocess')
+    values = list(threshold.values()) if isinstance(threshold,dict) else [threshold]
+    if not all(isinstance(value,(int,float)) and 0 <= value <= 1 for value in values):
+        return app.response_class(status=400,response="Thresholds must be numbers between 0 and 1.")
+    if isinstance(threshold,dict) and not set(threshold).issubset(oar_config.OARS):
+        return app.response_class(status=400,response="Unknown OAR in thresholds: {}".format(
+            ", ".join(sorted(set(threshold) - set(oar_config.OARS)))))
+    gated = [OAR for OAR, flag in probability_store.load_gated(os.path.join(workspace.output_folder,PROBABILITY_MAPS)).items() if flag]
+    too_low = [OAR for OAR in gated if (threshold.get(OAR,0.33) if isinstance(threshold,dict) else threshold) < z_gating.COARSE_THRESHOLD]
+    if len(too_low) > 0:
+        return app.response_class(status=400,response="Thresholds below {} cannot be used for z-gated OARs: {}".format(
+            z_gating.COARSE_THRESHOLD,", ".join(too_low)))
+    if postprocess is not None and not set(postprocess).issubset(createdicomfile.POSTPROCESS_DEFAULTS):
+        return app.response_class(status=400,response="Unknown postprocess flag, use {}".format(
+            ", ".join(createdicomfile.POSTPROCESS_DEFAULTS)))
+    workspace_manager.acquire(workspace)
+    try:
+        SS_fileID = recontour_structure_set(workspace,threshold,postprocess)
+    finally:
+        workspace_manager.release(workspace)
+    return jsonify(structure_set_result(workspace,SS_fileID))
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    job = submit_workspace_job('pipeline',run_pipeline_job,request.args.get('series_uid'))
+    if not isinstance(job,jobs.Job):
+        return job #error response
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress. Every event is JSON with at least
+    id, event ('state', 'stage' or 'progress'), state and stage; stage events add the
+    progress text, state events add result and error, progress events add
+    OAR, OAR_index, OAR_count, slices_done, slice_count and eta (seconds). The stream
+    ends after the job finishes or fails. Reconnecting clients send Last-Event-ID and
+    only receive what they missed.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return app.response_class(status=404,response="Unknown job ID.")
+    try:
+        last_id = max(0,int(request.headers.get('Last-Event-ID',request.args.get('last_event_id',0))))
+    except ValueError:
+        last_id = 0 #unreadable ID, replay every event still held
+
+    def stream(last_id):
+        yield 'retry: 2000\n\n'
+        while True:
+            events = job.wait_events(last_id,timeout=15)
+            if len(events) == 0:
+                if job.done and last_id >= job.sequence:
+                    return
+                yield ': keep-alive\n\n' #stops proxies from closing an idle stream
+                continue
+            for event in events:
+                last_id = event['id']
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'],event['event'],json.dumps(event))
+                if event['event'] == 'state' and event['state'] in ('finished','failed'):
+                    return
+
+    return app.response_class(stream(last_id),mimetype='text/event-stream',
+                              headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return app.response_class(status=404,response="Unknown job ID.")
+    return jsonify(job.to_dict())
+
+@app.route('/api/registry/stats', methods=['GET'])
+def registry_stats():
+    return jsonify({'threads':threads.stats(),'jobs':job_queue.jobs.stats(),'result_cache':results.stats()})
 
 @app.route('/api/cleanup',methods=['DELETE'])
 def delete_files():
     if request.method == "DELETE":
-        for file in os.listdir(app.config['UPLOAD_FOLDER']):
-            os.remove(os.path.join(app.config['UPLOAD_FOLDER'],file))
-        for file in os.listdir(app.config['OUTPUT_FOLDER']):
-            os.remove(os.path.join(app.config['OUTPUT_FOLDER'],file))
+        workspace_id = request.args.get('workspace_id','default') #only the requesting workspace is removed, never other users' files
+        if workspace_manager.get(workspace_id) is not None and not workspace_manager.delete(workspace_id):
+            return app.response_class(status=409,response="Workspace has a running job.")
         return app.response_class(status=200,response="All stored files deleted.")
         
 
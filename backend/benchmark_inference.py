@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the combined multi-OAR engine against the sequential per-OAR loop.
+
+Runs both paths on the same synthetic HU volume and reports wall-clock time and
+the largest difference between their probability maps. Trained weights are used
+if a weights folder is given, otherwise the freshly initialized weights are used
+(timings are the same either way).
+
+Usage: python benchmark_inference.py [num_slices] [weights_folder]
+"""
+import sys
+import time
+import numpy as np
+
+import image_prep
+import model_bank
+import oar_config
+import probability_store
+
+def synthetic_volume(num_slices,image_size=256,seed=0):
+    rng = np.random.default_rng(seed)
+    volume = np.full((num_slices,image_size,image_size,1),-1000,dtype=np.int16) #air
+    yy,xx = np.mgrid[:image_size,:image_size]
+    body = ((yy-image_size/2)**2 + (xx-image_size/2)**2) < (image_size*0.35)**2
+    for i in range(num_slices):
+        volume[i,body,0] = rng.normal(40,60,np.sum(body)).astype(np.int16) #soft tissue with noise
+    return volume
+
+def run_sequential(bank,windows):
+    predictions = {}
+    for OAR in bank.weights:
+        predictions[OAR] = bank.predict(OAR,windows.get(oar_config.OAR_WINDOWS[OAR]))
+    return predictions
+
+if __name__ == "__main__":
+    num_slices = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    weightsfolder = sys.argv[2] if len(sys.argv) > 2 else None
+
+    bank = model_bank.ModelBank(weightsfolder=weightsfolder)
+    bank.warmup()
+    engine = model_bank.MultiOARModel(bank)
+    engine.warmup()
+
+    windows = image_prep.WindowCache(synthetic_volume(num_slices),oar_config.FILTERS)
+    windows.get("bone"), windows.get("tissue") #build windows up front so only inference is timed
+
+    start = time.perf_counter()
+    sequential = run_sequential(bank,windows)
+    sequential_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    combined = engine.predict(windows)
+    combined_time = time.perf_counter() - start
+    combined = {OAR:probability_store.dequantize(prediction) for OAR, prediction in combined.items()} #combined maps are uint8, within 1/510 of sequential
+
+    maxdiff = max(float(np.max(np.abs(sequential[OAR]-combined[OAR]))) for OAR in sequential)
+    print("Slices: %d, OARs: %d" % (num_slices,len(sequential)))
+    print("Sequential loop: %.2f s" % sequential_time)
+    print("Combined engine: %.2f s (%.2fx)" % (combined_time,sequential_time/combined_time))
+    print("Max probability difference: %.2e" % maxdiff)
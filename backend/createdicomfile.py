@@ -1,6 +1,7 @@
 # Coded version of DICOM file 'F:\testfolder\structureset.dcm'
 # Produced by pydicom codify utility script
 import os
+import json
 import datetime
 import random
 import pydicom
@@ -77,6 +78,65 @@ def gather_patient_data(rootfolder):
     
     return check_dict, UIDdict
 
+def series_entry(imagefile):
+    """
+    Per-file part of gather_series_data: the patient data of the file, its slice height
+    and its (SOPClassUID, SOPInstanceUID) pair. Small enough to send back from an ingest worker.
+    """
+    sliceheight = round(imagefile.SliceLocation * 4) / 4 #rounds to nearest 0.25
+    return dataimport_dict(imagefile), sliceheight, (imagefile.SOPClassUID,imagefile.SOPInstanceUID)
+
+def collect_series_entries(entries,numfiles):
+    """
+    Checks that the entries from series_entry belong to one patient and builds the
+    patient data and UID dictionary. numfiles is the number of files that were considered.
+    """
+    UIDdict = {}
+    check_dict = None
+    invalidfiles = 0
+    for patient_data, sliceheight, UIDs in entries:
+        if check_dict is None:
+            check_dict = patient_data.copy()
+        if check_dict["PatientID"] != patient_data["PatientID"]:
+            print("Mismatching patient ID found, bypassing",UIDs[1])
+            invalidfiles += 1
+            continue
+        UIDdict[sliceheight] = UIDs
+    
+    if invalidfiles > (numfiles * 0.1):
+        raise Exception("Too many invalid files, double check input")
+    
+    return check_dict, UIDdict
+
+def gather_series_data(filelist):
+    """
+    Same output as gather_patient_data, but built from datasets that have already been
+    loaded during ingest so the CT files do not need to be read from disk a second time.
+    """
+    entries = [series_entry(imagefile) for imagefile in filelist if imagefile.Modality == "CT"]
+    return collect_series_entries(entries,len(filelist))
+
+def save_series_record(patient_data,UIDdict,filepath):
+    #compact per-series record written at ingest, stored as JSON so RTSTRUCT generation can skip re-reading the CT files
+    record = {"patient_data":{},"UIDdict":[]}
+    for key,value in patient_data.items():
+        if key in ("SeriesNumber","InstanceNumber"):
+            record["patient_data"][key] = int(value)
+        else:
+            record["patient_data"][key] = str(value)
+    for sliceheight in sorted(UIDdict.keys()):
+        record["UIDdict"].append([sliceheight,str(UIDdict[sliceheight][0]),str(UIDdict[sliceheight][1])])
+    with open(filepath,"w") as f:
+        json.dump(record,f)
+
+def load_series_record(filepath):
+    with open(filepath,"r") as f:
+        record = json.load(f)
+    UIDdict = {}
+    for sliceheight,classUID,instanceUID in record["UIDdict"]:
+        UIDdict[sliceheight] = (classUID,instanceUID)
+    return record["patient_data"], UIDdict
+
 def array_to_contour_coords(outputarray,heightlist,bilateral=False,image_size=256):
     contourelementlist = []
     for j in range(0,len(heightlist)):
@@ -109,10 +169,68 @@ def generate_random_UID():
     return UID
         
 
-def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshold=0.33):
+POSTPROCESS_DEFAULTS = {"height_prior":True, "scrap_stray":True, "z_smoothing":True}
+
+HEIGHT_LIMITS = {"Brainstem":27,"Parotid L":33,"Parotid R":33,"Submandibular L":17,
+                 "Submandibular R":17,"Larynx":18}
+
+def contour_roi(ROIName, prediction, heightlist, image_size=256, threshold=0.33, postprocess=None):
+    """
+    Thresholds and post-processes one ROI's probability map and converts it to contour
+    coordinates. The returned list of contour elements is all create_dicom needs of the
+    ROI, so the map can be released as soon as this returns.
+
+    threshold is a single value or a dictionary of ROI name -> value (ROIs not in it use 0.33)
+    postprocess switches the steps in POSTPROCESS_DEFAULTS on or off, missing keys keep the default
+    """
+    flags = dict(POSTPROCESS_DEFAULTS)
+    if postprocess is not None:
+        flags.update(postprocess)
+    ROIthreshold = threshold.get(ROIName,0.33) if isinstance(threshold,dict) else threshold
+    ROIarray = output_postprocess.apply_threshold(np.array(prediction),ROIthreshold) #copy, the probability map may be reused with other thresholds
+    if np.sum(ROIarray) == 0:
+        return [] #nothing above the threshold, e.g. organ not in the scan - the clean-up steps need at least one voxel
+    if flags["height_prior"] and ROIName in HEIGHT_LIMITS.keys():
+        ROIarray = output_postprocess.height_prior(ROIarray,HEIGHT_LIMITS[ROIName])
+        if np.sum(ROIarray) == 0:
+            return [] #height_prior never keeps the last slices, a hit only there is dropped
+    if flags["scrap_stray"]:
+        ROIarray = output_postprocess.scrap_stray(ROIarray)
+    if flags["z_smoothing"]:
+        ROIarray = output_postprocess.simple_z_smoothing(ROIarray)
+    
+    if ROIName == "BrachialPlexus":
+        bilateral = True
+    else:
+        bilateral = False
+    return array_to_contour_coords(ROIarray,heightlist, bilateral,image_size) #returns list of contour elements
+
+def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshold=0.33,postprocess=None):
     
     #structuresetdata will be a list of objects, each corresponding to an ROI
-    #each list item will be a dictionary
+    #structuresetdata is list of lists, each element will be [name,3Darray,heightlist]
+    contourdata = []
+    for ROI in structuresetdata:
+        contourdata.append([ROI[0],contour_roi(ROI[0],ROI[1],ROI[2],image_size,threshold,postprocess)])
+    return assemble_structure_set(patient_data, UIDdict, contourdata)
+
+def reissue_structure_set(source, destination):
+    """
+    Copies a stored structure set (e.g. from the result cache) with a new
+    SOPInstanceUID and creation time, so every file handed out is its own instance.
+    """
+    ds = pydicom.read_file(source)
+    GeneratedInstanceUID = '1.2.246.352.221.' + generate_random_UID()
+    ds.file_meta.MediaStorageSOPInstanceUID = GeneratedInstanceUID
+    ds.SOPInstanceUID = GeneratedInstanceUID
+    now = datetime.datetime.now()
+    ds.InstanceCreationDate = now.strftime("%Y%m%d")
+    ds.InstanceCreationTime = now.strftime("%H%M%S")
+    ds.save_as(destination, write_like_original=False)
+
+def assemble_structure_set(patient_data, UIDdict, contourdata):
+    
+    #contourdata is list of lists, each element will be [name,list of contour elements from contour_roi]
     
     #Establish creation date and time for DICOM file
     currentyear = str(datetime.date.today().year)
@@ -274,11 +392,11 @@ def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshol
     ds.StructureSetROISequence = structure_set_roi_sequence
     
     
-    for i in range(len(structuresetdata)):
+    for i in range(len(contourdata)):
         structure_set_roi = Dataset()
         structure_set_roi.ROINumber = i
         structure_set_roi.ReferencedFrameOfReferenceUID = patient_data["FrameOfReferenceUID"] #this is static, same for each element
-        structure_set_roi.ROIName = structuresetdata[i][0]
+        structure_set_roi.ROIName = contourdata[i][0]
         structure_set_roi.ROIGenerationAlgorithm = 'AUTOMATIC'
         structure_set_roi_sequence.append(structure_set_roi)
     
@@ -287,22 +405,10 @@ def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshol
     roi_contour_sequence = Sequence()
     ds.ROIContourSequence = roi_contour_sequence
     
-    height_limits = {"Brainstem":27,"Parotid L":33,"Parotid R":33,"Submandibular L":17,
-                     "Submandibular R":17,"Larynx":18}
-    #structuresetdata is list of lists, each element will be [name,3Darray,heightlist]
-    for i in range(len(structuresetdata)):
+    for i in range(len(contourdata)):
         # ROI Contour Sequence: ROI Contour 1
         
-        ROI = structuresetdata[i]
-        
-        ROIName = ROI[0]
-        ROIarray = output_postprocess.apply_threshold(ROI[1],threshold)
-        if ROIName in height_limits.keys():
-            ROIarray = output_postprocess.height_prior(ROIarray,height_limits[ROIName])
-        ROIarray = output_postprocess.scrap_stray(ROIarray)
-        ROIarray = output_postprocess.simple_z_smoothing(ROIarray)
-        ROIheightlist = ROI[2]
-        
+        ROIName = contourdata[i][0]
         
         roi_contour = Dataset()
         roi_contour.ROIDisplayColor = colordict[ROIName]#dictionary of approved colors by name [12, 191, 243]
@@ -311,11 +417,7 @@ def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshol
         contour_sequence = Sequence()
         roi_contour.ContourSequence = contour_sequence
         
-        if ROIName == "BrachialPlexus":
-            bilateral = True
-        else:
-            bilateral = False
-        listofelements = array_to_contour_coords(ROIarray,ROIheightlist, bilateral,image_size) #returns list of contour elements
+        listofelements = contourdata[i][1]
         for contourelement in listofelements:
             sliceheight = contourelement[2] #each element is in x,y,z format, so element[2] is the z-coord
             contour = Dataset()
@@ -339,16 +441,16 @@ def create_dicom(patient_data, UIDdict, structuresetdata,image_size=256,threshol
     rtroi_observations_sequence = Sequence()
     ds.RTROIObservationsSequence = rtroi_observations_sequence
     
-    for i in range(len(structuresetdata)):
+    for i in range(len(contourdata)):
         rtroi_observations = Dataset()
         rtroi_observations.ObservationNumber = i
         rtroi_observations.ReferencedROINumber = i
-        rtroi_observations.ROIObservationLabel = structuresetdata[i][0]
-        if "GTV" in structuresetdata[i][0]:
+        rtroi_observations.ROIObservationLabel = contourdata[i][0]
+        if "GTV" in contourdata[i][0]:
             rtroi_observations.RTROIInterpretedType = 'GTV' #'ORGAN' or 'PTV' or 'CTV' or 'GTV'
-        elif "PTV" in structuresetdata[i][0]:
+        elif "PTV" in contourdata[i][0]:
             rtroi_observations.RTROIInterpretedType = 'PTV'
-        elif "CTV" in structuresetdata[i][0]:
+        elif "CTV" in contourdata[i][0]:
             rtroi_observations.RTROIInterpretedType = 'CTV'
         else:
             rtroi_observations.RTROIInterpretedType = 'ORGAN'
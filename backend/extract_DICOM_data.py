@@ -16,6 +16,8 @@ Functions in this script:
     extract_dicom
         Input: directory path (string) or list of paths. Desired image size (pixels)
         Output: dictionaries with nested data storage
+        Note: files are classified from a header-only read first, only CT and
+        RTSTRUCT files are fully loaded
     crop_center
         Input: 2D image array, size to crop to
         Output: cropped array (cropped to center)
@@ -77,7 +79,10 @@ def extract_dicom(dir_path, image_size=512):
             for name in files:
                 if name.endswith(".dcm"):
                     filepath = os.path.join(root,name)
-                    dicomfile = pydicom.read_file(filepath) #will load each DICOM file in turn
+                    header = pydicom.read_file(filepath,stop_before_pixels=True,specific_tags=["Modality"])
+                    if header.get("Modality") not in ("CT","RTSTRUCT"):
+                        continue #header-only check lets dose, plan and stray files skip the full read
+                    dicomfile = pydicom.read_file(filepath) #will load each retained DICOM file in turn
                     
                     if dicomfile.Modality == "CT":
                         ID = dicomfile.PatientID
@@ -5,21 +5,96 @@ Created on Wed Oct 14 00:07:46 2020
 @author: johna
 """
 import os
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import pydicom
 import numpy as np
 import cv2
 
-def get_list_of_datasets(folderpath, modality="CT"):
-    filelist = []
-    for root, dirs, files in os.walk(folderpath): #we want to extract every dicom file in directory
+SERIES_TAGS = ["StudyInstanceUID","SeriesInstanceUID","FrameOfReferenceUID"]
+HEADER_TAGS = ["Modality","SliceLocation","PatientID","SeriesDescription"] + SERIES_TAGS
+#only the tags needed to classify, group and order a file - everything else waits for the full read
+
+def scan_headers(folderpath, tags=HEADER_TAGS):
+    """
+    Header-only pass over every .dcm file in a folder. Reading stops before the
+    pixel data and only the requested tags are parsed, so RTSTRUCT, RTDOSE, RTPLAN
+    and stray files are classified without paying for a full read.
+
+    Returns a dictionary keyed by Modality, each entry a list of (filepath, header)
+    tuples. Lists are sorted by slice height where SliceLocation is available.
+    """
+    headerdict = {}
+    for root, dirs, files in os.walk(folderpath): #we want to classify every dicom file in directory
         for name in files:
             if name.endswith(".dcm"):
                 filepath = os.path.join(root,name)
-                dicomfile = pydicom.read_file(filepath) #will load each DICOM file in turn
-                if dicomfile.Modality == modality:
-                    filelist.append(dicomfile)
+                header = pydicom.read_file(filepath,stop_before_pixels=True,specific_tags=tags)
+                modality = getattr(header,"Modality",None)
+                if modality not in headerdict:
+                    headerdict[modality] = []
+                headerdict[modality].append((filepath,header))
+    for modality in headerdict:
+        headerdict[modality].sort(key=lambda item: getattr(item[1],"SliceLocation",0))
+    return headerdict
+
+def index_series(headerdict, modality="CT"):
+    """
+    Groups the files of one modality from scan_headers by (StudyInstanceUID,
+    SeriesInstanceUID, FrameOfReferenceUID), so a folder holding several series
+    (e.g. planning CT and re-scan) never has their slices mixed together.
+    Each entry keeps the slice height ordering of scan_headers.
+    """
+    index = {}
+    for filepath, header in headerdict.get(modality,[]):
+        key = tuple(str(getattr(header,tag,"")) for tag in SERIES_TAGS)
+        if key not in index:
+            index[key] = []
+        index[key].append((filepath,header))
+    return index
+
+def describe_series(index):
+    summary = []
+    for key, entries in index.items():
+        heights = [float(header.SliceLocation) for filepath, header in entries if "SliceLocation" in header]
+        summary.append({"StudyInstanceUID":key[0],
+                        "SeriesInstanceUID":key[1],
+                        "FrameOfReferenceUID":key[2],
+                        "SeriesDescription":str(getattr(entries[0][1],"SeriesDescription","")),
+                        "num_slices":len(entries),
+                        "z_range":[min(heights),max(heights)] if len(heights) > 0 else None})
+    return summary
+
+def select_series(index, series_uid=None):
+    """
+    Returns the entries of the series with SeriesInstanceUID series_uid. Without a
+    series_uid the folder must hold a single series, otherwise a ValueError lists
+    the series the caller can pick from.
+    """
+    if series_uid is None:
+        if len(index) > 1:
+            raise ValueError("Upload holds {} CT series, pick one of: {}".format(
+                len(index), ", ".join(key[1] for key in index)))
+        return next(iter(index.values()),[])
+    for key, entries in index.items():
+        if key[1] == series_uid:
+            return entries
+    raise ValueError("Series {} not found in upload.".format(series_uid))
+
+def get_list_of_datasets(folderpath, modality="CT", series_uid=None):
+    filelist = []
+    for filepath in get_list_of_files(folderpath,modality,series_uid):
+        filelist.append(pydicom.read_file(filepath)) #full read only for the files we keep
     return filelist
 
+def get_list_of_files(folderpath, modality="CT", series_uid=None):
+    #same selection as get_list_of_datasets, but only the paths, build_array workers read the files themselves
+    headerdict = scan_headers(folderpath)
+    return [filepath for filepath, header in select_series(index_series(headerdict,modality),series_uid)]
+
 def process_image(file, image_size=512, pixel_size = 0.5):
     
     image = file.pixel_array.astype(np.int16)
@@ -51,6 +126,7 @@ def apply_window_level(image, windowwidth, windowlevel, normalize = False):
 
     upperlimit = windowlevel + (windowwidth / 2)
     lowerlimit = windowlevel - (windowwidth / 2)
+    image = np.array(image) #clip a copy so the caller's volume is never modified in place
     image[image > upperlimit] = upperlimit
     image[image < lowerlimit] = lowerlimit
 
@@ -59,7 +135,77 @@ def apply_window_level(image, windowwidth, windowlevel, normalize = False):
         image = (image-lowerlimit) / (upperlimit - lowerlimit)
 
     return image
-    
+
+class WindowCache:
+    """
+    Builds each distinct window/level volume of a patient once and hands the same
+    read-only array to every OAR that uses that window.
+    """
+    def __init__(self, volume, filters):
+        self.volume = volume
+        self.filters = filters #dictionary of name -> [window, level]
+        self.windowed = {}
+
+    def get(self, name):
+        if name not in self.windowed:
+            windowwidth, windowlevel = self.filters[name]
+            windowed = apply_window_level(self.volume, windowwidth, windowlevel)
+            windowed.setflags(write=False)
+            self.windowed[name] = windowed
+        return self.windowed[name]
+
+BODY_THRESHOLD_HU = -500 #above this a pixel is soft tissue or bone, below it air, lung or couch foam
+BODY_EROSION = 3 #pixels, wider than the couch shell and thermoplastic mask so only the patient is left
+BODY_MIN_AREA = 100 #pixels of eroded tissue a slice needs to count as holding the patient
+
+def _erode(mask, radius):
+    #square structuring element applied to every slice at once, done as a row pass then a column pass
+    for axis in (1,2):
+        size = mask.shape[axis]
+        padding = [(0,0)] * mask.ndim
+        padding[axis] = (radius,radius)
+        padded = np.pad(mask,padding)
+        eroded = np.ones_like(mask)
+        for offset in range(2 * radius + 1):
+            window = [slice(None)] * mask.ndim
+            window[axis] = slice(offset,offset + size)
+            eroded &= padded[tuple(window)]
+        mask = eroded
+    return mask
+
+def body_extent(volume, threshold=BODY_THRESHOLD_HU, erosion=BODY_EROSION, min_area=BODY_MIN_AREA):
+    """
+    Finds the part of an HU volume (as built by build_array) that holds the patient.
+
+    Returns
+    -------
+    slices : slice
+        Range of slices from the first to the last one with patient tissue.
+    box : tuple
+        (first row, end row, first column, end column) in-plane bounding box of the
+        tissue over those slices. Every slice and the full frame if no tissue is found.
+    """
+    tissue = _erode(volume[...,0] > threshold,erosion)
+    body = np.flatnonzero(tissue.sum(axis=(1,2)) >= min_area)
+    if len(body) == 0:
+        return slice(0,len(volume)), (0,volume.shape[1],0,volume.shape[2])
+    slices = slice(int(body[0]),int(body[-1]) + 1)
+    rows = np.flatnonzero(tissue[slices].any(axis=(0,2)))
+    cols = np.flatnonzero(tissue[slices].any(axis=(0,1)))
+    box = (max(0,int(rows[0]) - erosion),min(volume.shape[1],int(rows[-1]) + erosion + 1),
+           max(0,int(cols[0]) - erosion),min(volume.shape[2],int(cols[-1]) + erosion + 1)) #erosion shrank the outline, grow it back
+    return slices, box
+
+def restore_extent(prediction, slices, box, num_slices):
+    """
+    Places a prediction made on volume[slices] back into a map covering every slice,
+    with zero probability outside the body slices and outside the in-plane box.
+    """
+    full = np.zeros((num_slices,) + prediction.shape[1:],dtype=prediction.dtype)
+    row0, row1, col0, col1 = box
+    full[slices,row0:row1,col0:col1] = prediction[:,row0:row1,col0:col1]
+    return full
+
 def crop_center(img,cropto):      #function used later to trim images to standardized size if too big - trims to center
     y,x = img.shape
     startx = x//2-(cropto//2)
@@ -85,14 +231,65 @@ def unpad(array,original_size):
     sliceHere = slice(pad, pad + original_size)
     return array[sliceHere]
 
-def build_array(filelist,image_size=512,pixel_size=0.5):
+def _process_slice(ds,image_size,pixel_size):
+    #module-level so it can be pickled out to worker processes, ds is a dataset or the path of its file
+    if isinstance(ds,str):
+        ds = pydicom.read_file(ds)
+    image = process_image(ds,image_size,pixel_size)
+    sliceheight = round(ds.SliceLocation * 2) / 2
+    return sliceheight, image
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_process_pool(workers):
+    """
+    Process pool shared by build_array and stream_ingest, started on first use and kept
+    for the life of the server. It uses spawn, forking a server that has TensorFlow and
+    its threads running can deadlock the children.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def reset_process_pool(broken):
+    #a pool whose worker died refuses all further work, the next get_process_pool starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+
+def build_array(filelist,image_size=512,pixel_size=0.5,workers=1):
+    """
+    Decodes, rescales and stacks the CT slices in filelist (datasets or file paths),
+    ordered by slice height. With workers > 1 the read, decode and process_image work
+    is spread over the shared process pool. Pass file paths then, so every worker reads
+    its own files instead of the parent reading them and pickling the pixel data over.
+    Results are joined in the same order as the serial path so the output is identical.
+    """
     holding_dict = {}
     heightlist = []
     array = []
-    for ds in filelist:
-        image = process_image(ds,image_size,pixel_size)
-        sliceheight = round(ds.SliceLocation * 2) / 2
-        holding_dict[sliceheight] = image
+    if workers is not None and workers > 1 and len(filelist) > 1:
+        chunksize = max(1, len(filelist) // (workers * 4))
+        def run(pool):
+            return list(pool.map(_process_slice, filelist, itertools.repeat(image_size),
+                                 itertools.repeat(pixel_size), chunksize=chunksize))
+        pool = get_process_pool(workers)
+        try:
+            results = run(pool)
+        except BrokenProcessPool: #a worker died, start over once on a new pool
+            reset_process_pool(pool)
+            pool.shutdown(wait=False)
+            results = run(get_process_pool(workers))
+        for sliceheight, image in results:
+            holding_dict[sliceheight] = image
+    else:
+        for ds in filelist:
+            sliceheight, image = _process_slice(ds,image_size,pixel_size)
+            holding_dict[sliceheight] = image
     for height in sorted(holding_dict.keys()):
         heightlist.append(height)
         array.append(holding_dict[height])
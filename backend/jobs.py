@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Background job subsystem for the backend.
+
+Submitting work returns a Job immediately; a bounded pool of worker threads runs
+it in the background. Each job records its state, current stage, progress text
+and result location so the request handlers only have to look it up.
+
+Job states: queued -> running -> finished | failed
+
+Progress is also published as a sequence of structured events (see Job.emit) so
+that clients can subscribe to a stream instead of polling.
+"""
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import registry
+logger = logging.getLogger(name="Jobs")
+
+MAX_EVENTS = 1000 #events kept per job for late subscribers, older ones are dropped
+
+class QueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = 'queued'
+        self.stage = None
+        self.progress = ''
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def set_stage(self, stage, progress=''):
+        self.stage = stage
+        self.progress = progress
+        self.emit('stage',progress=progress)
+
+    def emit(self, event, **fields):
+        """
+        Publishes a progress event to subscribers. Every event carries the job state
+        and stage, fields adds event specific data (OAR index, slices done, ETA...).
+        """
+        with self.condition:
+            self.sequence += 1
+            data = {'id':self.sequence,'event':event,'job_id':self.id,'state':self.state,
+                    'stage':self.stage,'time':time.time()}
+            data.update(fields)
+            self.events.append(data)
+            self.condition.notify_all()
+
+    @property
+    def done(self):
+        return self.state in ('finished','failed')
+
+    def wait_events(self, after=0, timeout=15):
+        """
+        Returns the events with an id greater than after, waiting up to timeout
+        seconds for one to arrive. An empty list means nothing happened in time.
+        """
+        with self.condition:
+            if self.sequence <= after:
+                self.condition.wait(timeout)
+            return [e for e in self.events if e['id'] > after]
+
+    def to_dict(self):
+        return {'job_id':self.id,
+                'kind':self.kind,
+                'state':self.state,
+                'stage':self.stage,
+                'progress':self.progress,
+                'result':self.result,
+                'error':self.error,
+                'submitted':self.submitted,
+                'started':self.started,
+                'finished':self.finished}
+
+class JobQueue:
+    def __init__(self, max_workers=2, max_pending=16, max_jobs=256, job_ttl=3600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix='job')
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending) #caps running plus waiting jobs
+        self.jobs = registry.Registry(max(max_jobs,max_workers + max_pending),job_ttl) #finished jobs are evicted after job_ttl seconds
+
+    def submit(self, kind, fn, *args):
+        """
+        Queues fn(job, *args) to run on the worker pool. Whatever fn returns is stored
+        as the job result. Raises QueueFull when the backlog limit is reached.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise QueueFull("Job queue is full, try again later.")
+        job = Job(kind)
+        self.jobs.add(job,job.id)
+        self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def _run(self, job, fn, args):
+        job.state = 'running'
+        job.started = time.time()
+        job.emit('state')
+        try:
+            job.result = fn(job, *args)
+            job.state = 'finished'
+        except Exception as e:
+            job.error = '{}: {}'.format(type(e).__name__, e)
+            job.state = 'failed'
+            logger.exception("Job %s (%s) failed.", job.id, job.kind)
+        finally:
+            job.finished = time.time()
+            job.emit('state',result=job.result,error=job.error)
+            self.slots.release()
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
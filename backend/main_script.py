@@ -8,13 +8,14 @@ Created on Tue Oct 13 22:32:51 2020
 import os
 import numpy as np
 import datetime
-import pickle
 import threading
 
+import pydicom
+
 import image_prep
-import model
 #import predict_pretrained needs rework
 import createdicomfile
+import volume_store
 
 """
 
@@ -26,12 +27,57 @@ INPUT RECEIVED FROM BROWSER:
 
 """
 
-def validate_files(input_folder,output_folder):
-    datalist = image_prep.get_list_of_datasets(input_folder)
-    inputarray, heightlist = image_prep.build_array(datalist, image_size=256,pixel_size=1)
-    np.save(os.path.join(output_folder,"patient_volume.npy"), inputarray)
-    with open(os.path.join(output_folder,"slice_height_map.pckl"),"wb+") as f:
-        pickle.dump(heightlist,f)
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS",1)) #processes used to decode and resample CT slices, 1 decodes serially in the server process
+#more than 1 starts a shared pool of worker processes with spawn (see image_prep.get_process_pool), each worker imports the backend modules again
+
+def validate_files(input_folder,output_folder,series_uid=None):
+    """
+    Processes the CT series in input_folder into output_folder. If the folder holds
+    more than one series, series_uid picks the SeriesInstanceUID to use.
+    """
+    filepaths = image_prep.get_list_of_files(input_folder,series_uid=series_uid)
+    if len(filepaths) == 0:
+        raise ValueError("No CT images found in upload.") #same message as stream_ingest.StreamingIngest.finish
+    return ingest_files(filepaths,output_folder)
+
+def validate_all_series(input_folder,output_root):
+    """
+    Processes every CT series in input_folder, each into output_root/<SeriesInstanceUID>.
+    One header pass groups the files and every series is decoded once.
+    Returns a dictionary of SeriesInstanceUID -> output folder.
+    """
+    index = image_prep.index_series(image_prep.scan_headers(input_folder))
+    outputs = {}
+    for key, entries in index.items():
+        output_folder = os.path.join(output_root,key[1])
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        ingest_files([filepath for filepath, header in entries],output_folder)
+        outputs[key[1]] = output_folder
+    return outputs
+
+def ingest_files(filepaths,output_folder):
+    image_size = 256
+    pixel_size = 1
+    headers = [pydicom.read_file(filepath,stop_before_pixels=True) for filepath in filepaths] #series record only needs the tags
+    inputarray, heightlist = image_prep.build_array(filepaths, image_size=image_size,pixel_size=pixel_size,workers=INGEST_WORKERS) #workers read the pixel data
+    patient_data, UIDdict = createdicomfile.gather_series_data(headers)
+    return save_ingest(output_folder,inputarray,heightlist,patient_data,UIDdict,image_size,pixel_size)
+
+def save_ingest(output_folder,inputarray,heightlist,patient_data,UIDdict,image_size=256,pixel_size=1):
+    """
+    Writes the processed volume and the series record to output_folder, shared by
+    validate_files and the streaming ingest in stream_ingest.py.
+    """
+    if len(heightlist) > 1:
+        slicethickness = float(np.min(np.diff(heightlist)))
+    else:
+        slicethickness = 0.0
+    spacing = [pixel_size, pixel_size, slicethickness]
+    origin = [-image_size*pixel_size/2, -image_size*pixel_size/2, heightlist[0]] #processed images are centered on the patient origin
+    series_uids = {key:patient_data[key] for key in ("StudyInstanceUID","SeriesInstanceUID","FrameOfReferenceUID")}
+    volume_store.save_volume(os.path.join(output_folder,"patient_volume.vol"), inputarray, heightlist, spacing, origin, series_uids)
+    createdicomfile.save_series_record(patient_data,UIDdict,os.path.join(output_folder,"series_metadata.json"))
     success_message = "All DICOM files have been processed and packaged into array. Ready to begin neural network inference process."
     return success_message
         
@@ -49,7 +95,7 @@ def generate_ss(imagefolder,outputfolder,username):
     filters = {"bone":[2000, 400], "tissue":[400,40],"none":[4500,1000]}
     
     datalist = image_prep.get_list_of_datasets(imagefolder)
-    inputarray, heightlist = image_prep.build_array(datalist,image_size=256,pixel_size=1)
+    inputarray, heightlist = image_prep.build_array(datalist,image_size=256,pixel_size=1,workers=INGEST_WORKERS)
     
     if region == "Head and Neck":
         ROIlist = ["BrachialPlexus","Brain","CochleaL","CochleaR","Larynx","ParotidL","ParotidR","SpinalCord",
@@ -57,13 +103,14 @@ def generate_ss(imagefolder,outputfolder,username):
         
         weightspaths = {"Axial":".//weights"}
     
+    import model #imported here so validate_files can be used without loading TensorFlow
     image_size = 256
     AxialModel = model.get_unet(image_size)
 
     
     structuresetdata = []
     
-    AxialInput = np.copy(inputarray)
+    windows = image_prep.WindowCache(inputarray,filters) #each window is computed once and shared by the ROIs that use it
     
 
     for ROI in ROIlist:
@@ -77,18 +124,11 @@ def generate_ss(imagefolder,outputfolder,username):
 
         
         if ROI == "BrachialPlexus" or ROI == "SpinalCord": #this is the spot to edit if we want to change how filters are applied
-            win_lev = "Bone"
+            win_lev = "bone"
         else:
-            win_lev = "Tissue"
+            win_lev = "tissue"
         
-        if win_lev == "Tissue":
-            filtAxialInput = image_prep.apply_window_level(AxialInput,filters["tissue"][0],filters["tissue"][1])
-
-        elif win_lev == "Bone":
-            filtAxialInput = image_prep.apply_window_level(AxialInput,filters["bone"][0],filters["bone"][1])
-
-        elif win_lev == "None":
-            filtAxialInput = image_prep.apply_window_level(AxialInput,filters["none"][0],filters["none"][1])
+        filtAxialInput = windows.get(win_lev)
 
         
         AxialOutput = AxialModel.predict(filtAxialInput,verbose=0)
@@ -96,7 +136,7 @@ def generate_ss(imagefolder,outputfolder,username):
 
         structuresetdata.append([ROI,AxialOutput,heightlist]) #if returning to 3D, change AxialOutput to combinedoutput
         
-    patient_data,UIDdict = createdicomfile.gather_patient_data(imagefolder)
+    patient_data,UIDdict = createdicomfile.gather_series_data(datalist)
     structure_set = createdicomfile.create_dicom(patient_data,UIDdict,structuresetdata,image_size=256,threshold=threshold)
     
     filename = "RS.%s-CNN.dcm" % username
@@ -54,11 +54,7 @@ def get_dice_sum(predictions, test_labels,thresholding = False):
     dicetotal = (2. * intersectionsum + smooth) / (denominatorsum + smooth)
     return dicetotal
 
-def get_unet(image_size, num_channels=1):   #have adjusted filter size numbers to account for image size of 256
-    
-    assert image_size == 256
-    
-    inputs = Input((256, 256, num_channels))    #third number is the number of channels - configured for single W/L
+def unet_layers(inputs):   #builds the U-Net on an existing input tensor and returns the sigmoid output tensor
     conv1 = Conv2D(32, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(inputs)
     conv1 = Conv2D(32, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv1)
     pool1 = MaxPooling2D(pool_size=(2, 2))(conv1)
@@ -98,6 +94,14 @@ def get_unet(image_size, num_channels=1):   #have adjusted filter size numbers t
     conv9 = Conv2D(32, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv9)
     conv9 = Conv2D(2, 3, activation = 'relu', padding = 'same', kernel_initializer = 'he_normal')(conv9)
     conv10 = Conv2D(1, 1, activation = 'sigmoid')(conv9)
+    return conv10
+
+def get_unet(image_size, num_channels=1):   #have adjusted filter size numbers to account for image size of 256
+    
+    assert image_size % 16 == 0    #four poolings, the served models are 256 - tests build smaller graphs
+    
+    inputs = Input((image_size, image_size, num_channels))    #third number is the number of channels - configured for single W/L
+    conv10 = unet_layers(inputs)
 
     model = models.Model(inputs = inputs, outputs = conv10)
 
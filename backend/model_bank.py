@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Resident bank of OAR weight sets for the backend.
+
+The U-Net graph is built and compiled once at process start and every OAR's
+weights are read from the HDF5 files into memory up front. Serving a request
+then only swaps in-memory weight arrays into the existing graph, so no graph
+construction, compilation or disk reads happen per request.
+"""
+import hashlib
+import threading
+import numpy as np
+
+import model
+import probability_store
+from oar_config import OARS, OAR_WINDOWS, weights_path
+
+PREDICT_BATCH_SIZE = 32 #same as the Keras default, named so progress can be counted in slices
+
+class PredictProgress(model.callbacks.Callback):
+    """
+    Calls progress(slices_done) after every predicted batch.
+    """
+    def __init__(self, progress, num_slices, batch_size=PREDICT_BATCH_SIZE):
+        super().__init__()
+        self.progress = progress
+        self.num_slices = num_slices
+        self.batch_size = batch_size
+
+    def on_predict_batch_end(self, batch, logs=None):
+        self.progress(min((batch + 1) * self.batch_size, self.num_slices))
+
+def progress_callbacks(progress, num_slices):
+    if progress is None:
+        return []
+    return [PredictProgress(progress,num_slices)]
+
+class ModelBank:
+    def __init__(self, OARs=OARS, weightsfolder='weights', image_size=256):
+        self.image_size = image_size
+        self.neuralnet = model.get_unet(image_size)
+        self.weights = {}
+        for OAR in OARs:
+            if weightsfolder is not None: #None keeps the initialized weights, only useful for benchmarking
+                self.neuralnet.load_weights(weights_path(weightsfolder,OAR))
+            self.weights[OAR] = self.neuralnet.get_weights() #list of numpy arrays held in memory
+        self.loaded = None
+        self.lock = threading.Lock() #one graph is shared, so swapping and predicting must not interleave between jobs
+        self.ready = False
+        self._fingerprint = None
+
+    def fingerprint(self):
+        """
+        SHA-256 over every resident weight array, identifies the exact models in use.
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha256()
+            for OAR in sorted(self.weights):
+                digest.update(OAR.encode('utf-8'))
+                for array in self.weights[OAR]:
+                    digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def swap(self, OAR):
+        if self.loaded != OAR:
+            self.neuralnet.set_weights(self.weights[OAR])
+            self.loaded = OAR
+
+    def predict(self, OAR, volume, progress=None):
+        """
+        progress, if given, is called with the number of slices done after every batch.
+        """
+        with self.lock:
+            self.swap(OAR)
+            return self.neuralnet.predict(volume,batch_size=PREDICT_BATCH_SIZE,verbose=0,
+                                          callbacks=progress_callbacks(progress,len(volume)))
+
+    def warmup(self):
+        """
+        Runs one dummy slice through every weight set so that graph tracing and
+        memory allocation happen before the server starts taking requests.
+        """
+        dummy = np.zeros((1,self.image_size,self.image_size,1),dtype=np.float32)
+        for OAR in self.weights:
+            self.predict(OAR,dummy)
+        self.ready = True
+
+class MultiOARModel:
+    """
+    Every OAR network shares one architecture and input size, so instead of running
+    them one after another this joins all of them into a single graph with one U-Net
+    branch per OAR. Each branch is fed the window its OAR was trained on and a single
+    predict call returns every OAR's probability map.
+
+    The maps of all OARs come out together, so predict quantizes every batch to uint8
+    (see probability_store) as soon as it is predicted. A job holds one byte per voxel
+    and OAR instead of the four of float32 maps.
+    """
+    def __init__(self, bank, OAR_windows=OAR_WINDOWS):
+        self.OARs = list(bank.weights.keys())
+        self.window_names = sorted(set(OAR_windows[OAR] for OAR in self.OARs))
+        inputs = {name:model.Input((bank.image_size,bank.image_size,1),name=name) for name in self.window_names}
+        outputs = []
+        for OAR in self.OARs:
+            branch_input = inputs[OAR_windows[OAR]]
+            branch_output = model.unet_layers(branch_input)
+            branch = model.models.Model(inputs=branch_input,outputs=branch_output)
+            branch.set_weights(bank.weights[OAR]) #sub-model shares its layers with the combined graph
+            outputs.append(branch_output)
+        self.combined = model.models.Model(inputs=[inputs[name] for name in self.window_names],outputs=outputs)
+        self.image_size = bank.image_size
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def warmup(self):
+        dummy = np.zeros((1,self.image_size,self.image_size,1),dtype=np.float32)
+        with self.lock:
+            self.combined.predict([dummy for name in self.window_names],verbose=0)
+        self.ready = True
+
+    def predict(self, windows, progress=None):
+        """
+        Parameters
+        ----------
+        windows : image_prep.WindowCache
+            Window cache of the patient volume.
+        progress : callable, optional
+            Called with the number of slices done (for every OAR at once) after every batch.
+
+        Returns
+        -------
+        predictions : dict
+            OAR name -> uint8 quantized probability map of shape (slices, rows, cols, 1),
+            probability_store.dequantize turns it back into probabilities.
+        """
+        feed = [windows.get(name) for name in self.window_names]
+        num_slices = len(feed[0])
+        predictions = {OAR:np.zeros((num_slices,self.image_size,self.image_size,1),dtype=np.uint8) for OAR in self.OARs}
+        with self.lock:
+            for start in range(0,num_slices,PREDICT_BATCH_SIZE):
+                batch = slice(start,start + PREDICT_BATCH_SIZE)
+                outputs = self.combined.predict_on_batch([window[batch] for window in feed])
+                if len(self.OARs) == 1:
+                    outputs = [outputs]
+                for OAR, output in zip(self.OARs,outputs):
+                    predictions[OAR][batch] = probability_store.quantize(np.asarray(output)) #float32 outputs only live for one batch
+                if progress is not None:
+                    progress(min(start + PREDICT_BATCH_SIZE,num_slices))
+        return predictions
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+OAR list, window/level filters and weight file naming shared by the inference backends.
+Kept free of deep learning imports so any backend can use it.
+"""
+import os
+
+OARS = ['Brainstem', 'Cochlea L','Cochlea R','Parotid L','Parotid R',
+        'Submandibular L','Submandibular R','Brachial Plexus',
+        'Brain','Larynx','Spinal Cord']
+
+FILTERS = {"bone":[2000, 400], "tissue":[400,40],"none":[4500,1000]} #window/level filters
+
+OAR_WINDOWS = {OAR:('bone' if OAR in ('Spinal Cord','Brachial Plexus') else 'tissue') for OAR in OARS}
+
+Z_GATING_STRIDE_MM = {'Brainstem':10.0,'Parotid L':10.0,'Parotid R':10.0,
+                      'Submandibular L':7.5,'Submandibular R':7.5,'Larynx':7.5,
+                      'Brachial Plexus':7.5,'Cochlea L':5.0,'Cochlea R':5.0}
+#coarse sampling distance for z-range gating (z_gating.py), kept below each organ's smallest craniocaudal extent
+#Brain and Spinal Cord span most of the scan and are always predicted on every slice
+
+def weights_path(weightsfolder,OAR,extension='hdf5'):
+    return os.path.join(weightsfolder,'{}.{}'.format(OAR.replace(" ",""),extension))
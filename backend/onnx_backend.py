@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+ONNX Runtime inference backend for the OAR U-Nets.
+
+export_models converts the trained HDF5 weights to one .onnx file per OAR.
+OnnxModelBank serves those files on the CPU with the same predict/warmup
+interface as model_bank.ModelBank, so the backend can be picked at runtime.
+Serving through ONNX Runtime does not import TensorFlow or Keras.
+
+Run this file directly to export every OAR and then check parity against the
+Keras path on a synthetic volume:
+    python onnx_backend.py [weights_folder] [onnx_folder]
+"""
+import os
+import hashlib
+import threading
+import numpy as np
+import onnxruntime as ort
+
+from oar_config import OARS, OAR_WINDOWS, FILTERS, weights_path
+
+def export_models(weightsfolder='weights', onnxfolder=os.path.join('weights','onnx'), OARs=OARS, image_size=256, opset=12):
+    #export needs the Keras graph, imported here so that serving with ONNX Runtime never loads TensorFlow
+    import tensorflow as tf
+    import tf2onnx
+    import model
+
+    if not os.path.exists(onnxfolder):
+        os.makedirs(onnxfolder)
+    neuralnet = model.get_unet(image_size)
+    spec = (tf.TensorSpec((None,image_size,image_size,1),tf.float32,name="input"),)
+    for OAR in OARs:
+        neuralnet.load_weights(weights_path(weightsfolder,OAR))
+        tf2onnx.convert.from_keras(neuralnet,input_signature=spec,opset=opset,
+                                   output_path=weights_path(onnxfolder,OAR,'onnx'))
+        print("Exported",OAR)
+
+class OnnxModelBank:
+    def __init__(self, OARs=OARS, onnxfolder=os.path.join('weights','onnx'), image_size=256, batch_size=32, num_threads=0):
+        self.image_size = image_size
+        self.batch_size = batch_size
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads #0 lets ONNX Runtime use every physical core
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.sessions = {}
+        digest = hashlib.sha256()
+        for OAR in OARs:
+            self.sessions[OAR] = ort.InferenceSession(weights_path(onnxfolder,OAR,'onnx'),options,
+                                                      providers=['CPUExecutionProvider'])
+            digest.update(OAR.encode('utf-8'))
+            with open(weights_path(onnxfolder,OAR,'onnx'),'rb') as f:
+                digest.update(f.read())
+        self._fingerprint = digest.hexdigest()
+        self.weights = self.sessions #same keys as ModelBank.weights, callers iterate over it for the OAR list
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def fingerprint(self):
+        #SHA-256 over the model files, same role as ModelBank.fingerprint
+        return self._fingerprint
+
+    def predict(self, OAR, volume, progress=None):
+        session = self.sessions[OAR]
+        inputname = session.get_inputs()[0].name
+        outputs = []
+        with self.lock:
+            for start in range(0,len(volume),self.batch_size): #batches keep the activation memory bounded like Keras predict
+                batch = np.asarray(volume[start:start+self.batch_size],dtype=np.float32)
+                outputs.append(session.run(None,{inputname:batch})[0])
+                if progress is not None:
+                    progress(min(start + self.batch_size,len(volume)))
+        if len(outputs) == 0:
+            return np.zeros((0,self.image_size,self.image_size,1),dtype=np.float32)
+        return np.concatenate(outputs,axis=0)
+
+    def warmup(self):
+        dummy = np.zeros((1,self.image_size,self.image_size,1),dtype=np.float32)
+        for OAR in self.sessions:
+            self.predict(OAR,dummy)
+        self.ready = True
+
+def parity_check(keras_bank, onnx_bank, num_slices=40, threshold=0.33):
+    """
+    Runs both backends on the same synthetic volume and returns, per OAR, the largest
+    absolute difference between the probability maps and the Dice coefficient of the
+    two thresholded masks.
+    """
+    import image_prep
+    import evaluation_tool
+    import output_postprocess
+    from benchmark_inference import synthetic_volume
+
+    windows = image_prep.WindowCache(synthetic_volume(num_slices,onnx_bank.image_size),FILTERS)
+    results = {}
+    for OAR in onnx_bank.sessions:
+        volume = windows.get(OAR_WINDOWS[OAR])
+        keras_prediction = keras_bank.predict(OAR,volume)
+        onnx_prediction = onnx_bank.predict(OAR,volume)
+        maxdiff = float(np.max(np.abs(keras_prediction - onnx_prediction)))
+        keras_mask = output_postprocess.apply_threshold(np.copy(keras_prediction),threshold)
+        onnx_mask = output_postprocess.apply_threshold(np.copy(onnx_prediction),threshold)
+        results[OAR] = (maxdiff, evaluation_tool.get_dicescore(keras_mask,onnx_mask))
+    return results
+
+if __name__ == "__main__":
+    import sys
+    import model_bank
+
+    weightsfolder = sys.argv[1] if len(sys.argv) > 1 else 'weights'
+    onnxfolder = sys.argv[2] if len(sys.argv) > 2 else os.path.join(weightsfolder,'onnx')
+    export_models(weightsfolder,onnxfolder)
+
+    keras_bank = model_bank.ModelBank(weightsfolder=weightsfolder)
+    onnx_bank = OnnxModelBank(onnxfolder=onnxfolder)
+    for OAR,(maxdiff,dice) in parity_check(keras_bank,onnx_bank).items():
+        print("%-16s max prob diff %.2e   thresholded Dice %.4f" % (OAR,maxdiff,dice))
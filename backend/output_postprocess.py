@@ -92,7 +92,7 @@ def scrap_stray(binary_array):
     compressed = np.zeros(len(binary_array))
     for i in range(len(binary_array)):
         compressed[i] = np.sum(binary_array[i])
-    idx = np.squeeze(np.argwhere(compressed))
+    idx = np.flatnonzero(compressed) #stays 1-D when a single slice is set
     chunks = np.split(compressed[idx],np.where(np.diff(idx)!=1)[0]+1)
     chunkvals = np.zeros(len(chunks))
     for i in range(len(chunks)):
@@ -101,7 +101,7 @@ def scrap_stray(binary_array):
     N = len(biggest)
     possibles = np.where(compressed == biggest[0])[0]
     for p in possibles:
-        if np.all(compressed[p:p+N] == biggest):
+        if np.array_equal(compressed[p:p+N],biggest):
             startindex = p
     clean_array = np.zeros(binary_array.shape)
     clean_array[startindex:startindex+N] = binary_array[startindex:startindex+N]
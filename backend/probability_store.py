@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Compact store of the raw sigmoid outputs of a job.
+
+Each OAR's probability map is quantized to uint8 (256 levels, step 1/255) and
+written to a compressed .npz next to the structure set, so the RTSTRUCT can be
+rebuilt with other thresholds or post-processing without calling the network.
+Most of a map is near zero, so the compressed file is a small fraction of the
+float32 arrays. Quantization moves a voxel across a threshold only when its
+probability is within 1/510 of it.
+
+MapWriter adds one OAR at a time, so a job never has to hold every map at once.
+Maps that are already uint8 (model_bank.MultiOARModel quantizes while it predicts)
+are stored as they are. Every map carries a flag telling whether it was z-gated
+(zero outside the slab found by the coarse pass, see z_gating.py).
+It writes to a temporary file that only replaces the previous maps once complete,
+so readers never see a partial archive and a failed job keeps the last good maps.
+"""
+import os
+import zipfile
+import threading
+import numpy as np
+
+LEVELS = 255
+
+def quantize(prediction):
+    return np.round(np.clip(prediction,0,1) * LEVELS).astype(np.uint8)
+
+def dequantize(quantized):
+    return quantized.astype(np.float32) / LEVELS
+
+class MapWriter:
+    """
+    Writes maps into the .npz one OAR at a time, same file layout as np.savez_compressed.
+    add may be called from several threads, maps are written one after another.
+    """
+    def __init__(self, filepath, heightlist):
+        self.filepath = filepath
+        self.temppath = filepath + '.{}.tmp'.format(threading.get_ident()) #unique per writer thread
+        self.archive = zipfile.ZipFile(self.temppath, "w", compression=zipfile.ZIP_DEFLATED)
+        self.heightlist = heightlist
+        self.OARs = []
+        self.gated = []
+        self.lock = threading.Lock()
+
+    def write(self, name, array):
+        with self.archive.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+    def add(self, OAR, prediction, gated=False):
+        quantized = prediction if prediction.dtype == np.uint8 else quantize(prediction)
+        with self.lock:
+            self.write("map_{}".format(len(self.OARs)), quantized)
+            self.OARs.append(OAR)
+            self.gated.append(gated)
+
+    def close(self):
+        with self.lock:
+            self.write("OARs", np.array(self.OARs))
+            self.write("gated", np.array(self.gated,dtype=bool))
+            self.write("heightlist", np.array(self.heightlist,dtype=np.float64))
+            self.archive.close()
+        os.replace(self.temppath, self.filepath)
+
+    def discard(self):
+        with self.lock:
+            self.archive.close()
+        os.remove(self.temppath)
+
+def save_maps(filepath, predictions, heightlist):
+    """
+    Parameters
+    ----------
+    filepath : str
+        Destination .npz file.
+    predictions : dict
+        OAR name -> probability map of shape (slices, rows, cols, 1).
+    heightlist : list
+        Slice heights corresponding positionally to the slices of every map.
+    """
+    writer = MapWriter(filepath, heightlist)
+    for OAR, prediction in predictions.items():
+        writer.add(OAR, prediction)
+    writer.close()
+
+def iter_maps(filepath):
+    """
+    Yields (OAR name, float32 probability map) one OAR at a time, only the current
+    map is decompressed and held in memory.
+    """
+    with np.load(filepath) as data:
+        for i, OAR in enumerate(data["OARs"]):
+            yield str(OAR), dequantize(data["map_{}".format(i)])
+
+def load_gated(filepath):
+    """
+    Returns a dictionary of OAR name -> True if its map was z-gated. Files written
+    before the flags were stored count every OAR as gated.
+    """
+    with np.load(filepath) as data:
+        OARs = [str(OAR) for OAR in data["OARs"]]
+        if "gated" not in data.files:
+            return {OAR:True for OAR in OARs}
+        return {OAR:bool(gated) for OAR, gated in zip(OARs,data["gated"])}
+
+def load_heightlist(filepath):
+    with np.load(filepath) as data:
+        return [float(h) for h in data["heightlist"]]
+
+def load_maps(filepath):
+    """
+    Returns
+    -------
+    predictions : dict
+        OAR name -> float32 probability map, in the order the maps were saved.
+    heightlist : list
+        Slice heights of the maps.
+    """
+    with np.load(filepath) as data:
+        OARs = [str(OAR) for OAR in data["OARs"]]
+        predictions = {OAR:dequantize(data["map_{}".format(i)]) for i, OAR in enumerate(OARs)}
+        heightlist = [float(h) for h in data["heightlist"]]
+    return predictions, heightlist
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded registry for upload threads, CNN threads and background jobs.
+
+IDs are random UUIDs so they never collide. Items that have finished are evicted
+once they are older than the TTL, and when the registry is full the oldest
+finished (or never started) item makes room for the new one. Expiry runs on
+every access, so a long-running server holds at most max_size items without
+needing a cleanup thread.
+
+An item is considered started once its started attribute is set and finished
+once its finished attribute is set; both hold time.time() timestamps.
+"""
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+logger = logging.getLogger(name="Registry")
+
+class RegistryFull(Exception):
+    pass
+
+class Registry:
+    def __init__(self, max_size=256, ttl=3600):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of items held at once.
+        ttl : float
+            Seconds a finished item stays available for status queries.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict() #insertion order, oldest first
+        self.lock = threading.Lock()
+        self.evicted_expired = 0
+        self.evicted_capacity = 0
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def add(self, item, item_id=None):
+        """
+        Stores item and returns its ID. Raises RegistryFull if every held item is
+        still in progress.
+        """
+        if item_id is None:
+            item_id = self.new_id()
+        with self.lock:
+            self._expire()
+            if item_id not in self.items and len(self.items) >= self.max_size:
+                self._evict_one()
+            self.items[item_id] = item
+        return item_id
+
+    def replace(self, item_id, item):
+        """
+        Swaps the item held under item_id for item. Returns False if item_id is not
+        held, so an ID can only be reused once the registry has handed it out.
+        """
+        with self.lock:
+            self._expire()
+            if item_id not in self.items:
+                return False
+            self.items[item_id] = item
+            return True
+
+    def get(self, item_id):
+        with self.lock:
+            self._expire()
+            return self.items.get(item_id)
+
+    def __contains__(self, item_id):
+        return self.get(item_id) is not None
+
+    def _expire(self):
+        now = time.time()
+        expired = [k for k,item in self.items.items()
+                   if getattr(item,'finished',None) is not None and now - item.finished > self.ttl]
+        for k in expired:
+            del self.items[k]
+        self.evicted_expired += len(expired)
+
+    def _evict_one(self):
+        #finished items go first, then items that were created but never used
+        for condition in (lambda item: getattr(item,'finished',None) is not None,
+                          lambda item: getattr(item,'started',None) is None):
+            for k,item in self.items.items():
+                if condition(item):
+                    del self.items[k]
+                    self.evicted_capacity += 1
+                    return
+        raise RegistryFull("Too many jobs in progress, try again later.")
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            finished = sum(1 for item in self.items.values() if getattr(item,'finished',None) is not None)
+            return {'size':len(self.items),
+                    'max_size':self.max_size,
+                    'ttl':self.ttl,
+                    'finished':finished,
+                    'in_progress':len(self.items) - finished,
+                    'evicted_expired':self.evicted_expired,
+                    'evicted_capacity':self.evicted_capacity}
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of generated structure sets.
+
+The key is a SHA-256 over the processed patient volume, its series record, the
+fingerprint of the loaded model weights and the post-processing parameters, so
+re-uploading the same CT returns the stored RTSTRUCT without running inference
+again, while any change to the images, weights or thresholds misses the cache.
+
+Each entry is a set of plain files named <key><extension>, e.g. the structure set
+(.dcm) and the probability maps it was contoured from (.npz). Their modification
+time is refreshed on every hit and the least recently used entries are removed,
+all files of a key together, when the cache grows past its disk budget. The index
+is rebuilt from the folder on start-up.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+logger = logging.getLogger(name="ResultCache")
+
+HASH_BLOCK = 1024*1024
+
+def hash_file(digest, filepath):
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+
+def cache_key(volume_path, record_path, model_fingerprint, params):
+    """
+    Parameters
+    ----------
+    volume_path : str
+        patient_volume.vol written by ingest.
+    record_path : str
+        series_metadata.json written by ingest. Part of the key because the RTSTRUCT
+        references the series' UIDs, not only its pixels.
+    model_fingerprint : str
+        Fingerprint of the weights in use, see ModelBank.fingerprint.
+    params : dict
+        Anything else that changes the output, e.g. threshold and image size.
+    """
+    digest = hashlib.sha256()
+    hash_file(digest, volume_path)
+    hash_file(digest, record_path)
+    digest.update(model_fingerprint.encode('utf-8'))
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, root, budget=2*1024**3):
+        self.root = root
+        self.budget = budget
+        self.entries = OrderedDict() #key -> {extension: size in bytes}, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.exists(root):
+            os.makedirs(root)
+        found = {}
+        for name in os.listdir(root):
+            if name.endswith('.tmp') or '.' not in name:
+                continue
+            key, extension = name.split('.', 1)
+            path = os.path.join(root, name)
+            mtime, files = found.setdefault(key, (0, {}))
+            files['.' + extension] = os.path.getsize(path)
+            found[key] = (max(mtime, os.path.getmtime(path)), files)
+        for key, (mtime, files) in sorted(found.items(), key=lambda item: item[1][0]):
+            self.entries[key] = files
+
+    def path(self, key, extension='.dcm'):
+        return os.path.join(self.root, key + extension)
+
+    def get(self, key):
+        """
+        Returns {extension: path} of the files cached for key, or None on a miss.
+        """
+        with self.lock:
+            files = self.entries.get(key)
+            if files is None or not all(os.path.exists(self.path(key, ext)) for ext in files):
+                self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            for ext in files:
+                os.utime(self.path(key, ext)) #keeps the LRU order across restarts
+            return {ext: self.path(key, ext) for ext in files}
+
+    def put(self, key, files):
+        """
+        Stores files ({extension: path}, e.g. the structure set and its probability
+        maps) under key. They count against the budget and are evicted together.
+        """
+        sizes = {ext: os.path.getsize(filepath) for ext, filepath in files.items()}
+        if sum(sizes.values()) > self.budget:
+            return
+        temppaths = {}
+        for ext, filepath in files.items():
+            temppaths[ext] = self.path(key, ext) + '.{}.tmp'.format(threading.get_ident()) #unique per writer thread
+            shutil.copyfile(filepath, temppaths[ext])
+        with self.lock:
+            self.remove(key)
+            for ext, temppath in temppaths.items():
+                os.replace(temppath, self.path(key, ext))
+            self.entries[key] = sizes
+            total = sum(sum(entry.values()) for entry in self.entries.values())
+            while total > self.budget:
+                oldkey = next(iter(self.entries))
+                total -= sum(self.entries[oldkey].values())
+                self.remove(oldkey)
+                self.evictions += 1
+                logger.info("Evicted %s from result cache.", oldkey)
+
+    def remove(self, key):
+        #caller holds self.lock
+        for ext in self.entries.pop(key, {}):
+            try:
+                os.remove(self.path(key, ext))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'entries':len(self.entries),
+                    'bytes':sum(sum(entry.values()) for entry in self.entries.values()),
+                    'budget':self.budget,
+                    'hits':self.hits,
+                    'misses':self.misses,
+                    'evictions':self.evictions}
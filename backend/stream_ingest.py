@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming ingest: CT slices are decoded while the upload is still arriving.
+
+Every file saved by an upload endpoint is handed to StreamingIngest.add_file,
+which queues it on a shared worker pool straight away. The worker reads the
+header, skips anything that is not CT, and decodes and resamples the slice with
+process_image. When the client asks for validation only the already decoded
+slices have to be stacked and written, so decode time overlaps with network
+time instead of following it.
+
+The overlap is between requests: werkzeug reads a whole multipart body before
+request.files returns, so the frontend sends each file in its own request and
+the slices of one request decode while the next ones are sent.
+
+iter_archive does the same for a tar archive sent as the raw request body:
+members are read from the stream into memory and parsed from there, nothing is
+extracted to disk.
+
+An archive member's bytes are dropped as soon as its slice is decoded. Only with
+a process pool are they kept until then: if a worker process dies the pool is
+replaced and the files it lost are decoded again. The decoded slices are
+released once finish has written the patient volume.
+"""
+import io
+import os
+import tarfile
+import zipfile
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pydicom
+
+import image_prep
+import createdicomfile
+import main_script
+
+MAX_MEMBER_SIZE = 64*1024*1024 #archive members larger than this are not DICOM slices and are skipped
+READ_CHUNK = 1024*1024
+
+class ArchiveTooLarge(Exception):
+    pass
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    #one pool shared by every upload, created on first use
+    if main_script.INGEST_WORKERS > 1:
+        return image_prep.get_process_pool(main_script.INGEST_WORKERS) #same processes as image_prep.build_array
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=1) #still overlaps decoding with the upload
+        return _pool
+
+def reset_pool(broken):
+    #a pool whose worker died refuses all further work, the next get_pool starts a new one
+    global _pool
+    image_prep.reset_process_pool(broken)
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+def submit(fn, *args):
+    pool = get_pool()
+    try:
+        return pool.submit(fn,*args)
+    except BrokenProcessPool:
+        reset_pool(pool)
+        return get_pool().submit(fn,*args)
+
+def _read(source,**kwargs):
+    if isinstance(source,bytes):
+        source = io.BytesIO(source) #archive member held in memory
+    return pydicom.read_file(source,**kwargs)
+
+def _ingest_file(source,image_size,pixel_size):
+    #module-level so it can be pickled out to worker processes, source is a file path or the file's bytes
+    try:
+        header = _read(source,stop_before_pixels=True,specific_tags=image_prep.HEADER_TAGS)
+    except pydicom.errors.InvalidDicomError:
+        if isinstance(source,bytes):
+            return None #archives often carry DICOMDIR, readme and viewer files
+        raise
+    if getattr(header,"Modality",None) != "CT":
+        return None
+    ds = _read(source)
+    sliceheight, image = image_prep._process_slice(ds,image_size,pixel_size)
+    return sliceheight, image, createdicomfile.series_entry(ds)
+
+def list_dicom_files(folderpath):
+    filepaths = set()
+    for root, dirs, files in os.walk(folderpath):
+        for name in files:
+            if name.endswith(".dcm"):
+                filepaths.add(os.path.join(root,name))
+    return filepaths
+
+class _PrefixedStream:
+    #puts the bytes read to sniff the archive type back in front of a non-seekable stream
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if len(self.prefix) == 0:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b""
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+def _read_all(stream, max_size=None):
+    #reads to the end of the stream, raising ArchiveTooLarge once more than max_size bytes arrived
+    data = io.BytesIO()
+    while True:
+        chunk = stream.read(READ_CHUNK)
+        if not chunk:
+            return data
+        data.write(chunk)
+        if max_size is not None and data.tell() > max_size:
+            raise ArchiveTooLarge("Zip archives are held in memory and may be at most {} bytes, "
+                                  "send larger studies as a tar archive.".format(max_size))
+
+def iter_archive(stream, max_size=None):
+    """
+    Yields (member name, member bytes) for every regular file in a zip or tar archive
+    (tar may be gzip, bz2 or xz compressed). Tar archives are walked as a stream, one
+    member at a time. Zip keeps its index at the end of the file, so the archive is
+    held in memory first, at most max_size bytes of it. Nothing is written to disk.
+    """
+    prefix = stream.read(4)
+    if prefix.startswith(b"PK"):
+        with zipfile.ZipFile(_read_all(_PrefixedStream(prefix,stream),max_size)) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.file_size <= MAX_MEMBER_SIZE:
+                    yield info.filename, archive.read(info)
+    else:
+        with tarfile.open(fileobj=_PrefixedStream(prefix,stream),mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.size <= MAX_MEMBER_SIZE:
+                    yield member.name, archive.extractfile(member).read()
+
+class StreamingIngest:
+    def __init__(self, input_folder, output_folder, image_size=256, pixel_size=1):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.image_size = image_size
+        self.pixel_size = pixel_size
+        self.futures = {} #filepath -> future, a re-uploaded file replaces its earlier result
+        self.sources = {} #filepath -> path or bytes of a pending slice, to decode it again if its worker dies (process pool only)
+        self.lock = threading.Lock()
+
+    def add(self, key, source):
+        future = submit(_ingest_file,source,self.image_size,self.pixel_size)
+        with self.lock:
+            self.futures[key] = future
+            if main_script.INGEST_WORKERS > 1: #threads cannot die under a future, nothing to decode again
+                self.sources[key] = source
+        future.add_done_callback(lambda future: self._decoded(key,future))
+
+    def _decoded(self, key, future):
+        #the slice is decoded, its archive member bytes are not needed any more
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            if self.futures.get(key) is future:
+                self.sources.pop(key,None)
+
+    def add_file(self, filepath):
+        if not filepath.endswith(".dcm"):
+            return
+        self.add(os.path.abspath(filepath),os.path.abspath(filepath))
+
+    def add_bytes(self, name, data):
+        self.add(name,data)
+
+    def covers_folder(self):
+        """
+        True if every DICOM file in the input folder went through add_file, e.g. not
+        the case for files uploaded before a server restart.
+        """
+        with self.lock:
+            queued = set(self.futures.keys())
+        return len(queued) > 0 and list_dicom_files(os.path.abspath(self.input_folder)) == queued
+
+    def pending(self):
+        with self.lock:
+            return sum(1 for future in self.futures.values() if not future.done())
+
+    def series_index(self):
+        """
+        Waits for the outstanding slices and groups the decoded ones the same way as
+        image_prep.index_series. Errors from any file are raised here.
+        """
+        with self.lock:
+            items = list(self.futures.items())
+            sources = dict(self.sources)
+        retried = {}
+        for key, future in items:
+            try:
+                future.result()
+            except BrokenProcessPool: #its worker died, decode the file again on a new pool
+                retried[key] = submit(_ingest_file,sources[key],self.image_size,self.pixel_size)
+        index = {}
+        for result in [retried.get(key,future).result() for key, future in items]:
+            if result is None:
+                continue
+            patient_data = result[2][0]
+            key = tuple(str(patient_data[tag]) for tag in image_prep.SERIES_TAGS)
+            if key not in index:
+                index[key] = []
+            index[key].append(result)
+        return index
+
+    def finish(self, series_uid=None):
+        """
+        Writes the patient volume and series record of the selected series, same output
+        as main_script.validate_files.
+        """
+        ctresults = image_prep.select_series(self.series_index(),series_uid)
+        if len(ctresults) == 0:
+            raise ValueError("No CT images found in upload.")
+        holding_dict = {}
+        for sliceheight, image, entry in ctresults:
+            holding_dict[sliceheight] = image
+        heightlist = sorted(holding_dict.keys())
+        inputarray = np.asarray([holding_dict[height] for height in heightlist])
+        patient_data, UIDdict = createdicomfile.collect_series_entries([result[2] for result in ctresults],len(ctresults))
+        message = main_script.save_ingest(self.output_folder,inputarray,heightlist,patient_data,UIDdict,
+                                          self.image_size,self.pixel_size)
+        self.release()
+        return message
+
+    def release(self):
+        #the volume is on disk, the decoded slices and archive members are no longer needed
+        with self.lock:
+            self.futures = {}
+            self.sources = {}
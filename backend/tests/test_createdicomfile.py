@@ -0,0 +1,16 @@
+import numpy as np
+
+import createdicomfile
+
+def test_empty_roi_has_no_contours():
+    #a threshold above the map's maximum, or an organ that is not in the scan, gives no contours instead of an error
+    prediction = np.zeros((5, 32, 32, 1), dtype=np.float32)
+    assert createdicomfile.contour_roi('Brain', prediction, [0.0, 1.0, 2.0, 3.0, 4.0], 32, 0.33) == []
+    prediction[1:4, 10:16, 10:16] = 0.8
+    assert createdicomfile.contour_roi('Brain', prediction, [0.0, 1.0, 2.0, 3.0, 4.0], 32, 0.9) == []
+    assert len(createdicomfile.contour_roi('Brain', prediction, [0.0, 1.0, 2.0, 3.0, 4.0], 32, 0.5)) == 3
+
+def test_single_slice_roi():
+    prediction = np.zeros((3, 32, 32, 1), dtype=np.float32)
+    prediction[2, 10:16, 10:16] = 0.8
+    assert len(createdicomfile.contour_roi('Brain', prediction, [0.0, 1.0, 2.0], 32, 0.5)) == 1
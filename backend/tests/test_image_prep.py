@@ -0,0 +1,33 @@
+import numpy as np
+
+import image_prep
+
+def phantom(num_slices=20, size=64):
+    #air everywhere, a 2 pixel couch shell under the patient and a 20x24 pixel patient on slices 5-14
+    volume = np.full((num_slices, size, size, 1), -1000.0)
+    volume[:, 50:52, 5:60] = 300
+    volume[5:15, 20:40, 16:40] = 40
+    return volume
+
+def test_body_extent_excludes_air_slices_and_couch():
+    slices, box = image_prep.body_extent(phantom())
+    assert slices == slice(5, 15)
+    assert box == (20, 40, 16, 40)
+
+def test_body_extent_without_tissue_keeps_everything():
+    volume = np.full((6, 32, 32, 1), -1000.0)
+    assert image_prep.body_extent(volume) == (slice(0, 6), (0, 32, 0, 32))
+
+def test_body_box_is_clipped_to_the_frame():
+    volume = np.full((4, 32, 32, 1), -1000.0)
+    volume[:, :, :] = 40
+    assert image_prep.body_extent(volume) == (slice(0, 4), (0, 32, 0, 32))
+
+def test_restore_extent():
+    volume = phantom()
+    slices, box = image_prep.body_extent(volume)
+    prediction = np.full((10, 64, 64, 1), 0.5, dtype=np.float32)
+    full = image_prep.restore_extent(prediction, slices, box, len(volume))
+    assert full.shape == (20, 64, 64, 1) and full.dtype == np.float32
+    assert np.all(full[5:15, 20:40, 16:40] == 0.5)
+    assert full.sum() == 0.5 * 10 * 20 * 24
@@ -0,0 +1,68 @@
+import time
+import threading
+
+import pytest
+
+import jobs
+
+def wait_done(job, timeout=5):
+    while not job.done:
+        assert len(job.wait_events(job.sequence, timeout)) > 0, "job did not finish"
+
+def test_job_result_and_state():
+    queue = jobs.JobQueue(max_workers=1, max_pending=1)
+    job = queue.submit('test', lambda job, a, b: a + b, 2, 3)
+    wait_done(job)
+    assert job.state == 'finished'
+    assert job.result == 5
+    assert job.started is not None and job.finished >= job.started
+    assert queue.get(job.id) is job
+
+def test_failed_job_keeps_error():
+    def fail(job):
+        raise ValueError("bad series")
+    queue = jobs.JobQueue(max_workers=1, max_pending=1)
+    job = queue.submit('test', fail)
+    wait_done(job)
+    assert job.state == 'failed'
+    assert job.error == 'ValueError: bad series'
+    assert job.to_dict()['error'] == job.error
+
+def test_queue_full_until_a_job_finishes():
+    release = threading.Event()
+    queue = jobs.JobQueue(max_workers=1, max_pending=1)
+    running = queue.submit('test', lambda job: release.wait(5))
+    waiting = queue.submit('test', lambda job: None)
+    with pytest.raises(jobs.QueueFull):
+        queue.submit('test', lambda job: None)
+    release.set()
+    wait_done(running)
+    wait_done(waiting)
+    deadline = time.time() + 5
+    while True: #slots are released just after the final state event
+        try:
+            job = queue.submit('test', lambda job: None)
+            break
+        except jobs.QueueFull:
+            assert time.time() < deadline
+            time.sleep(0.01)
+    wait_done(job)
+
+def test_events_are_numbered_and_replayed():
+    job = jobs.Job('test')
+    job.set_stage('inference', 'Loading patient volume...')
+    job.emit('progress', OAR='Brainstem', slices_done=32)
+    events = job.wait_events(0, timeout=0)
+    assert [e['id'] for e in events] == [1, 2]
+    assert events[0]['event'] == 'stage' and events[0]['progress'] == 'Loading patient volume...'
+    assert events[1]['stage'] == 'inference' and events[1]['slices_done'] == 32
+    assert [e['id'] for e in job.wait_events(1, timeout=0)] == [2]
+    assert job.wait_events(2, timeout=0.01) == []
+
+def test_final_state_event_carries_result():
+    queue = jobs.JobQueue(max_workers=1, max_pending=1)
+    job = queue.submit('test', lambda job: {'file_id':'abc'})
+    wait_done(job)
+    final = job.wait_events(0, timeout=0)[-1]
+    assert final['event'] == 'state' and final['state'] == 'finished'
+    assert final['result'] == {'file_id':'abc'}
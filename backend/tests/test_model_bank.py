@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+import image_prep
+import model_bank
+import oar_config
+import probability_store
+from benchmark_inference import run_sequential, synthetic_volume
+
+OARS = ['Brainstem', 'Cochlea L']
+
+@pytest.fixture(scope='module')
+def bank():
+    bank = model_bank.ModelBank(OARs=OARS, weightsfolder=None, image_size=32)
+    bank.weights['Cochlea L'] = [array * 0.5 for array in bank.weights['Cochlea L']] #two distinct weight sets
+    return bank
+
+def volume(num_slices=3, size=32):
+    return np.random.RandomState(0).rand(num_slices, size, size, 1).astype(np.float32)
+
+def test_predict_swaps_resident_weights(bank):
+    brainstem = bank.predict('Brainstem', volume())
+    assert bank.loaded == 'Brainstem' and brainstem.shape == (3, 32, 32, 1)
+    cochlea = bank.predict('Cochlea L', volume())
+    assert bank.loaded == 'Cochlea L'
+    assert not np.allclose(brainstem, cochlea)
+    assert np.allclose(bank.predict('Brainstem', volume()), brainstem)
+
+def test_progress_counts_slices(bank):
+    done = []
+    bank.predict('Brainstem', volume(40), progress=done.append)
+    assert done == [32, 40]
+
+def test_fingerprint_identifies_the_weights(bank):
+    assert bank.fingerprint() == bank.fingerprint() and len(bank.fingerprint()) == 64
+    other = model_bank.ModelBank(OARs=OARS, weightsfolder=None, image_size=32) #new random initialization
+    assert other.fingerprint() != bank.fingerprint()
+
+def test_warmup(bank):
+    bank.warmup()
+    assert bank.ready
+
+def test_combined_graph_matches_sequential_predictions(bank):
+    windows = image_prep.WindowCache(synthetic_volume(4, 32), oar_config.FILTERS)
+    combined = model_bank.MultiOARModel(bank)
+    done = []
+    predictions = combined.predict(windows, progress=done.append)
+    sequential = run_sequential(bank, windows)
+    assert list(predictions) == OARS and done == [4]
+    for OAR in OARS:
+        assert predictions[OAR].dtype == np.uint8 #quantized batch by batch
+        assert np.abs(probability_store.dequantize(predictions[OAR]) - sequential[OAR]).max() <= 0.5 / probability_store.LEVELS + 1e-5
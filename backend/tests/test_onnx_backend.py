@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tf2onnx') #exporting needs the Keras graph
+import model_bank
+import oar_config
+import onnx_backend
+
+OARS = ['Brainstem', 'Cochlea L']
+
+@pytest.fixture(scope='module')
+def banks(tmp_path_factory):
+    weightsfolder = str(tmp_path_factory.mktemp('weights'))
+    onnxfolder = os.path.join(weightsfolder, 'onnx')
+    keras_bank = model_bank.ModelBank(OARs=OARS, weightsfolder=None, image_size=32)
+    for OAR in OARS:
+        keras_bank.swap(OAR)
+        keras_bank.neuralnet.save_weights(oar_config.weights_path(weightsfolder, OAR))
+    onnx_backend.export_models(weightsfolder, onnxfolder, OARS, image_size=32)
+    return keras_bank, onnx_backend.OnnxModelBank(OARS, onnxfolder, image_size=32, batch_size=8)
+
+def test_onnx_matches_keras(banks):
+    keras_bank, onnx_bank = banks
+    for OAR, (maxdiff, dice) in onnx_backend.parity_check(keras_bank, onnx_bank, num_slices=4).items():
+        assert maxdiff < 1e-4, OAR
+
+def test_progress_and_empty_volume(banks):
+    onnx_bank = banks[1]
+    done = []
+    prediction = onnx_bank.predict('Brainstem', np.zeros((10, 32, 32, 1)), progress=done.append)
+    assert prediction.shape == (10, 32, 32, 1) and done == [8, 10]
+    assert onnx_bank.predict('Brainstem', np.zeros((0, 32, 32, 1))).shape == (0, 32, 32, 1)
+
+def test_fingerprint_covers_the_model_files(banks):
+    onnx_bank = banks[1]
+    assert len(onnx_bank.fingerprint()) == 64
+    assert onnx_bank.fingerprint() != banks[0].fingerprint()
@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import probability_store
+
+def maps():
+    rng = np.random.RandomState(0)
+    return {'Brainstem':rng.rand(4, 8, 8, 1).astype(np.float32),
+            'Cochlea L':rng.rand(4, 8, 8, 1).astype(np.float32)}
+
+def test_quantization_error_is_half_a_level():
+    prediction = np.linspace(-0.5, 1.5, 1001, dtype=np.float32)
+    restored = probability_store.dequantize(probability_store.quantize(prediction))
+    assert np.abs(restored - np.clip(prediction, 0, 1)).max() <= 0.5 / probability_store.LEVELS + 1e-6
+
+def test_round_trip(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    predictions = maps()
+    probability_store.save_maps(filepath, predictions, [-1.5, 0.0, 1.5, 3.0])
+    loaded, heightlist = probability_store.load_maps(filepath)
+    assert list(loaded) == list(predictions)
+    assert heightlist == [-1.5, 0.0, 1.5, 3.0]
+    assert probability_store.load_heightlist(filepath) == heightlist
+    for OAR, prediction in probability_store.iter_maps(filepath):
+        assert loaded[OAR].dtype == np.float32 and loaded[OAR].shape == prediction.shape
+        assert np.abs(prediction - predictions[OAR]).max() <= 0.5 / probability_store.LEVELS + 1e-6
+
+def test_quantized_maps_are_stored_as_they_are(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    predictions = {OAR:probability_store.quantize(prediction) for OAR, prediction in maps().items()}
+    probability_store.save_maps(filepath, predictions, [0.0, 1.0, 2.0, 3.0])
+    loaded, heightlist = probability_store.load_maps(filepath)
+    for OAR in predictions:
+        assert np.array_equal(probability_store.quantize(loaded[OAR]), predictions[OAR])
+
+def test_gated_flags(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    writer = probability_store.MapWriter(filepath, [0.0, 1.0, 2.0, 3.0])
+    for OAR, prediction in maps().items():
+        writer.add(OAR, prediction, gated=(OAR == 'Cochlea L'))
+    writer.close()
+    assert probability_store.load_gated(filepath) == {'Brainstem':False, 'Cochlea L':True}
+
+def test_maps_without_flags_count_as_gated(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    np.savez_compressed(filepath, OARs=np.array(['Brainstem']), map_0=np.zeros((1, 8, 8, 1), dtype=np.uint8),
+                        heightlist=np.array([0.0]))
+    assert probability_store.load_gated(filepath) == {'Brainstem':True}
+
+def test_previous_maps_are_kept_until_close(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    probability_store.save_maps(filepath, maps(), [0.0, 1.0, 2.0, 3.0])
+    writer = probability_store.MapWriter(filepath, [0.0])
+    writer.add('Brainstem', np.zeros((1, 8, 8, 1)))
+    assert list(probability_store.load_maps(filepath)[0]) == ['Brainstem', 'Cochlea L']
+    writer.close()
+    assert list(probability_store.load_maps(filepath)[0]) == ['Brainstem']
+    assert os.listdir(str(tmp_path)) == ['probability_maps.npz']
+
+def test_discard_keeps_previous_maps(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    probability_store.save_maps(filepath, maps(), [0.0, 1.0, 2.0, 3.0])
+    writer = probability_store.MapWriter(filepath, [0.0])
+    writer.add('Brainstem', np.zeros((1, 8, 8, 1)))
+    writer.discard()
+    assert os.listdir(str(tmp_path)) == ['probability_maps.npz']
+    assert probability_store.load_heightlist(filepath) == [0.0, 1.0, 2.0, 3.0]
+
+def test_concurrent_adds(tmp_path):
+    filepath = str(tmp_path / 'probability_maps.npz')
+    predictions = {'OAR {}'.format(i):np.full((2, 8, 8, 1), i / 10) for i in range(8)}
+    writer = probability_store.MapWriter(filepath, [0.0, 1.0])
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda item: writer.add(*item), predictions.items()))
+    writer.close()
+    loaded, heightlist = probability_store.load_maps(filepath)
+    assert sorted(loaded) == sorted(predictions)
+    for OAR, prediction in loaded.items():
+        assert np.allclose(prediction, predictions[OAR], atol=1 / probability_store.LEVELS)
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import registry
+
+class Item:
+    def __init__(self, started=None, finished=None):
+        self.started = started
+        self.finished = finished
+
+def test_add_and_get():
+    items = registry.Registry()
+    item = Item()
+    item_id = items.add(item)
+    assert len(item_id) == 32
+    assert items.get(item_id) is item
+    assert item_id in items
+    assert items.get('missing') is None
+
+def test_finished_items_expire_after_ttl():
+    items = registry.Registry(ttl=60)
+    old = items.add(Item(started=0, finished=time.time() - 120))
+    recent = items.add(Item(started=0, finished=time.time()))
+    running = items.add(Item(started=time.time() - 120))
+    assert items.get(old) is None
+    assert items.get(recent) is not None
+    assert items.get(running) is not None
+    assert items.stats()['evicted_expired'] == 1
+
+def test_capacity_evicts_finished_then_unstarted():
+    items = registry.Registry(max_size=2)
+    unstarted = items.add(Item())
+    finished = items.add(Item(started=0, finished=time.time()))
+    items.add(Item(started=time.time()))
+    assert finished not in items
+    assert unstarted in items
+    items.add(Item(started=time.time()))
+    assert unstarted not in items
+    assert items.stats()['evicted_capacity'] == 2
+
+def test_full_of_running_items():
+    items = registry.Registry(max_size=1)
+    items.add(Item(started=time.time()))
+    with pytest.raises(registry.RegistryFull):
+        items.add(Item(started=time.time()))
+
+def test_replace_only_known_ids():
+    items = registry.Registry(max_size=1)
+    item_id = items.add(Item())
+    job = Item(started=time.time())
+    assert items.replace(item_id, job)
+    assert items.get(item_id) is job
+    assert not items.replace('chosen-by-client', Item())
+    assert 'chosen-by-client' not in items
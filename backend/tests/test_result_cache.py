@@ -0,0 +1,80 @@
+import os
+import time
+
+import result_cache
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+def test_cache_key_covers_every_input(tmp_path):
+    volume = write(tmp_path / 'patient_volume.vol', b'pixels')
+    record = write(tmp_path / 'series_metadata.json', b'{}')
+    key = result_cache.cache_key(volume, record, 'weights', {'threshold':0.33})
+    assert key == result_cache.cache_key(volume, record, 'weights', {'threshold':0.33})
+    assert key != result_cache.cache_key(volume, record, 'other weights', {'threshold':0.33})
+    assert key != result_cache.cache_key(volume, record, 'weights', {'threshold':0.5})
+    write(tmp_path / 'series_metadata.json', b'{"other":1}')
+    assert key != result_cache.cache_key(volume, record, 'weights', {'threshold':0.33})
+
+def test_hit_and_miss(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'))
+    assert cache.get('a') is None
+    cache.put('a', {'.dcm':write(tmp_path / 'RS.dcm', b'structure set'),
+                    '.npz':write(tmp_path / 'maps.npz', b'maps')})
+    files = cache.get('a')
+    assert sorted(files) == ['.dcm', '.npz']
+    with open(files['.dcm'], 'rb') as f:
+        assert f.read() == b'structure set'
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+def test_entry_with_missing_file_is_a_miss(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'))
+    cache.put('a', {'.dcm':write(tmp_path / 'RS.dcm', b'structure set'),
+                    '.npz':write(tmp_path / 'maps.npz', b'maps')})
+    os.remove(cache.path('a', '.npz'))
+    assert cache.get('a') is None
+    assert not os.path.exists(cache.path('a', '.dcm'))
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'), budget=25)
+    source = {'.dcm':write(tmp_path / 'RS.dcm', b'0123456789')}
+    cache.put('a', source)
+    cache.put('b', source)
+    cache.get('a')
+    cache.put('c', source)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.stats()['evictions'] == 1
+
+def test_all_files_of_a_key_share_one_budget(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'), budget=35)
+    source = {'.dcm':write(tmp_path / 'RS.dcm', b'0123456789'),
+              '.npz':write(tmp_path / 'maps.npz', b'0123456789')}
+    cache.put('a', source)
+    cache.put('b', source)
+    assert cache.stats()['bytes'] == 20
+    assert cache.get('a') is None
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['b.dcm', 'b.npz']
+
+def test_index_is_rebuilt_in_lru_order(tmp_path):
+    root = str(tmp_path / 'cache')
+    cache = result_cache.ResultCache(root, budget=45)
+    source = {'.dcm':write(tmp_path / 'RS.dcm', b'0123456789'),
+              '.npz':write(tmp_path / 'maps.npz', b'0123456789')}
+    cache.put('a', source)
+    cache.put('b', source)
+    for ext in source:
+        os.utime(cache.path('b', ext), (time.time() - 60, time.time() - 60))
+    restarted = result_cache.ResultCache(root, budget=45)
+    assert restarted.stats()['entries'] == 2 and restarted.stats()['bytes'] == 40
+    restarted.put('c', source)
+    assert restarted.get('b') is None and sorted(restarted.get('a')) == ['.dcm', '.npz']
+
+def test_files_over_budget_are_not_stored(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'), budget=15)
+    cache.put('a', {'.dcm':write(tmp_path / 'RS.dcm', b'0123456789'),
+                    '.npz':write(tmp_path / 'maps.npz', b'0123456789')})
+    assert cache.get('a') is None
+    assert os.listdir(str(tmp_path / 'cache')) == []
@@ -0,0 +1,122 @@
+import io
+import tarfile
+import zipfile
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pytest
+
+import stream_ingest
+
+class BrokenPool:
+    def submit(self, *args):
+        raise BrokenProcessPool("worker died")
+
+    def shutdown(self, wait=True):
+        pass
+
+def fake_slice(source, image_size, pixel_size):
+    height = float(source[-5]) if isinstance(source, str) else 0.0
+    entry = ({'StudyInstanceUID':'1', 'SeriesInstanceUID':'1.1', 'FrameOfReferenceUID':'1.2'}, {})
+    return height, np.zeros((image_size, image_size, 1)), entry
+
+def test_broken_pool_is_replaced(monkeypatch):
+    broken = BrokenPool()
+    monkeypatch.setattr(stream_ingest, '_pool', broken)
+    assert stream_ingest.submit(pow, 2, 3).result() == 8
+    assert stream_ingest._pool is not broken
+
+def test_files_lost_with_a_worker_are_decoded_again(monkeypatch):
+    monkeypatch.setattr(stream_ingest, '_ingest_file', fake_slice)
+    ingest = stream_ingest.StreamingIngest(None, None, image_size=4)
+    ingest.add_file('/upload/1.dcm')
+    lost = concurrent.futures.Future()
+    lost.set_exception(BrokenProcessPool("worker died"))
+    ingest.futures['/upload/2.dcm'] = lost
+    ingest.sources['/upload/2.dcm'] = '/upload/2.dcm'
+    index = ingest.series_index()
+    assert sorted(result[0] for result in index[('1', '1.1', '1.2')]) == [1.0, 2.0]
+
+def test_finish_releases_decoded_slices(monkeypatch):
+    monkeypatch.setattr(stream_ingest, '_ingest_file', fake_slice)
+    monkeypatch.setattr(stream_ingest.createdicomfile, 'collect_series_entries', lambda entries, n: ({}, {}))
+    saved = []
+    monkeypatch.setattr(stream_ingest.main_script, 'save_ingest', lambda folder, array, heights, *args: saved.append(heights) or 'saved')
+    ingest = stream_ingest.StreamingIngest(None, None, image_size=4)
+    ingest.add_file('/upload/2.dcm')
+    ingest.add_file('/upload/1.dcm')
+    ingest.add_file('/upload/readme.txt')
+    assert ingest.finish() == 'saved'
+    assert saved == [[1.0, 2.0]]
+    assert ingest.futures == {} and ingest.sources == {}
+
+def test_decoded_sources_are_dropped(monkeypatch):
+    monkeypatch.setattr(stream_ingest, '_ingest_file', fake_slice)
+    ingest = stream_ingest.StreamingIngest(None, None, image_size=4)
+    ingest.add_bytes('study/1.dcm', b'slice')
+    ingest.futures['study/1.dcm'].result()
+    assert ingest.sources == {}
+
+def test_process_pool_keeps_sources_until_decoded(monkeypatch):
+    pending = concurrent.futures.Future()
+    monkeypatch.setattr(stream_ingest.main_script, 'INGEST_WORKERS', 2)
+    monkeypatch.setattr(stream_ingest, 'submit', lambda fn, *args: pending)
+    ingest = stream_ingest.StreamingIngest(None, None, image_size=4)
+    ingest.add_bytes('study/1.dcm', b'slice')
+    assert ingest.sources == {'study/1.dcm':b'slice'}
+    pending.set_result(None)
+    assert ingest.sources == {}
+
+class OneWayStream:
+    #request streams cannot seek
+    def __init__(self, data):
+        self.buffer = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.buffer.read(size)
+
+def make_tar(members, mode='w:gz'):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as archive:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            archive.addfile(info, io.BytesIO(content))
+        folder = tarfile.TarInfo('study/empty')
+        folder.type = tarfile.DIRTYPE
+        archive.addfile(folder)
+    return data.getvalue()
+
+def make_zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('study/empty/', b'')
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+MEMBERS = {'study/1.dcm':b'first', 'study/2.dcm':b'second' * 100}
+
+def test_iter_zip():
+    assert dict(stream_ingest.iter_archive(OneWayStream(make_zip(MEMBERS)))) == MEMBERS
+
+def test_iter_tar_stream():
+    for mode in ('w', 'w:gz', 'w:bz2'):
+        assert dict(stream_ingest.iter_archive(OneWayStream(make_tar(MEMBERS, mode)))) == MEMBERS
+
+def test_oversized_members_are_skipped(monkeypatch):
+    monkeypatch.setattr(stream_ingest, 'MAX_MEMBER_SIZE', 10)
+    assert dict(stream_ingest.iter_archive(OneWayStream(make_zip(MEMBERS)))) == {'study/1.dcm':b'first'}
+
+def test_zip_size_is_capped():
+    data = make_zip(MEMBERS)
+    assert dict(stream_ingest.iter_archive(OneWayStream(data), len(data))) == MEMBERS
+    with pytest.raises(stream_ingest.ArchiveTooLarge):
+        list(stream_ingest.iter_archive(OneWayStream(data), len(data) - 1))
+
+def test_prefixed_stream():
+    stream = stream_ingest._PrefixedStream(b'abc', OneWayStream(b'defg'))
+    assert stream.read(2) == b'ab'
+    assert stream.read(3) == b'cde'
+    assert stream.read() == b'fg'
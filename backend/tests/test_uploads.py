@@ -0,0 +1,64 @@
+import os
+import hashlib
+
+import pytest
+
+import uploads
+import workspaces
+
+@pytest.fixture
+def workspace(tmp_path):
+    return workspaces.WorkspaceManager(str(tmp_path)).create()
+
+def test_merge_ranges():
+    assert uploads.merge_ranges([], 0, 4) == [[0, 4]]
+    assert uploads.merge_ranges([[0, 4]], 8, 12) == [[0, 4], [8, 12]]
+    assert uploads.merge_ranges([[0, 4], [8, 12]], 4, 8) == [[0, 12]]
+    assert uploads.merge_ranges([[0, 10]], 2, 5) == [[0, 10]]
+
+def test_out_of_order_chunks(workspace):
+    manager = uploads.UploadManager()
+    data = bytes(range(10))
+    status = manager.write_chunk(workspace, 'a.dcm', 5, 10, data[5:])
+    assert status == {'size':10, 'received':0, 'complete':False}
+    status = manager.write_chunk(workspace, 'a.dcm', 0, 10, data[:5], hashlib.sha256(data[:5]).hexdigest())
+    assert status == {'size':10, 'received':10, 'complete':True}
+    manager.finish(workspace, 'a.dcm', hashlib.sha256(data).hexdigest())
+    with open(os.path.join(workspace.upload_folder, 'a.dcm'), 'rb') as f:
+        assert f.read() == data
+    assert os.listdir(workspace.partial_folder) == []
+
+def test_resume_after_restart(workspace):
+    uploads.UploadManager().write_chunk(workspace, 'a.dcm', 0, 8, b'abcd')
+    manager = uploads.UploadManager() #new process, state comes from the partial folder
+    assert manager.session(workspace, 'a.dcm').status() == {'size':8, 'received':4, 'complete':False}
+    assert manager.write_chunk(workspace, 'a.dcm', 4, None, b'efgh')['complete']
+
+def test_rejected_chunks(workspace):
+    manager = uploads.UploadManager()
+    with pytest.raises(uploads.ChunkError):
+        manager.write_chunk(workspace, 'a.dcm', 0, None, b'abcd') #first chunk needs the size
+    with pytest.raises(uploads.ChunkError):
+        manager.write_chunk(workspace, 'a.dcm', 0, 4, b'abcd', 'not the checksum')
+    manager.write_chunk(workspace, 'a.dcm', 0, 4, b'ab')
+    with pytest.raises(uploads.ChunkError):
+        manager.write_chunk(workspace, 'a.dcm', 2, 4, b'cde') #past the end
+    with pytest.raises(uploads.ChunkError):
+        manager.write_chunk(workspace, 'a.dcm', 2, 5, b'cd') #different size
+    with pytest.raises(uploads.ChunkError):
+        manager.finish(workspace, 'a.dcm') #incomplete
+
+def test_size_limit(workspace):
+    manager = uploads.UploadManager(max_size=1024)
+    with pytest.raises(uploads.FileTooLarge):
+        manager.write_chunk(workspace, 'a.dcm', 0, 10**12, b'abcd')
+    with pytest.raises(uploads.FileTooLarge):
+        manager.write_chunk(workspace, 'a.dcm', 0, -1, b'')
+    assert not os.path.exists(os.path.join(workspace.partial_folder, 'a.dcm'))
+
+def test_file_checksum_mismatch(workspace):
+    manager = uploads.UploadManager()
+    manager.write_chunk(workspace, 'a.dcm', 0, 4, b'abcd')
+    with pytest.raises(uploads.ChunkError):
+        manager.finish(workspace, 'a.dcm', hashlib.sha256(b'abce').hexdigest())
+    assert not os.path.exists(os.path.join(workspace.upload_folder, 'a.dcm'))
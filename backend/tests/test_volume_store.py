@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+import volume_store
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "patient_volume.vol")
+    volume = np.arange(3*8*8, dtype=np.int16).reshape(3, 8, 8, 1) - 1000
+    uids = {"StudyInstanceUID":"1.2", "SeriesInstanceUID":"1.2.3", "FrameOfReferenceUID":"1.2.4"}
+    volume_store.save_volume(path, volume, [-5.0, -2.5, 0.0], [1, 1, 2.5], [-4, -4, -5.0], uids)
+    loaded, header = volume_store.load_volume(path)
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, volume)
+    assert header["heightlist"] == [-5.0, -2.5, 0.0]
+    assert header["spacing"] == [1.0, 1.0, 2.5]
+    assert header["series_uids"] == uids
+    assert header["offset"] % volume_store.ALIGNMENT == 0
+
+def test_loaded_volume_is_read_only(tmp_path):
+    path = str(tmp_path / "patient_volume.vol")
+    volume_store.save_volume(path, np.zeros((1, 4, 4, 1)), [0.0], [1, 1, 1], [0, 0, 0], {})
+    loaded, header = volume_store.load_volume(path)
+    with pytest.raises(ValueError):
+        loaded[0, 0, 0, 0] = 1
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "other.vol"
+    path.write_bytes(b"not a volume")
+    with pytest.raises(ValueError):
+        volume_store.read_header(str(path))
@@ -0,0 +1,94 @@
+import os
+import time
+
+import workspaces
+
+def write(workspace, name, size):
+    with open(os.path.join(workspace.upload_folder, name), 'wb') as f:
+        f.write(b'\0' * size)
+
+def test_create_and_get(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path))
+    workspace = manager.create()
+    assert os.path.isdir(workspace.upload_folder) and os.path.isdir(workspace.output_folder)
+    assert manager.get(workspace.id) is workspace
+    assert manager.create(workspace.id) is workspace
+    assert manager.get('../etc') is None
+    assert manager.get(None) is None
+
+def test_leftover_workspaces_are_adopted(tmp_path):
+    workspace = workspaces.WorkspaceManager(str(tmp_path)).create()
+    assert workspaces.WorkspaceManager(str(tmp_path)).get(workspace.id) is not None
+
+def test_retention(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path), retention=60)
+    old = manager.create()
+    busy = manager.create()
+    fresh = manager.create()
+    manager.acquire(busy)
+    old.last_used = busy.last_used = time.time() - 120
+    removed = manager.collect()
+    assert removed == [old.id]
+    assert not os.path.exists(old.root)
+    assert manager.get(busy.id) is busy and manager.get(fresh.id) is fresh
+
+def test_quota_removes_oldest_idle_first(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path), quota=1500)
+    first, second, third = manager.create(), manager.create(), manager.create()
+    for i, workspace in enumerate((first, second, third)):
+        write(workspace, 'a.dcm', 1000)
+        workspace.last_used = time.time() - 100 + i
+    deleted = []
+    manager.on_delete.append(deleted.append)
+    assert manager.collect() == [first.id, second.id]
+    assert deleted == [first.id, second.id]
+    assert manager.get(third.id) is third
+
+def test_delete_refuses_active_workspace(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path))
+    workspace = manager.create()
+    manager.acquire(workspace)
+    assert not manager.delete(workspace.id)
+    manager.release(workspace)
+    assert manager.delete(workspace.id)
+
+def test_release_does_not_collect(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path), retention=0)
+    workspace = manager.create()
+    manager.acquire(workspace)
+    manager.release(workspace)
+    assert manager.get(workspace.id) is workspace
+
+def test_usage_is_cached_until_used(tmp_path):
+    workspace = workspaces.WorkspaceManager(str(tmp_path)).create()
+    write(workspace, 'a.dcm', 100)
+    assert workspace.disk_usage(cached=True) == 100
+    write(workspace, 'b.dcm', 100)
+    assert workspace.disk_usage(cached=True) == 100 #not used since the last walk
+    workspace.last_used = workspace.measured + 1
+    assert workspace.disk_usage(cached=True) == 200
+    assert workspace.disk_usage() == 200
+
+def test_collector_thread(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path), retention=0)
+    workspace = manager.create()
+    workspace.last_used = time.time() - 1
+    thread = manager.start_collector(interval=0.01)
+    deadline = time.time() + 5
+    while workspace.id in manager.workspaces and time.time() < deadline:
+        time.sleep(0.01)
+    manager.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not os.path.exists(workspace.root)
+
+def test_one_job_per_workspace(tmp_path):
+    manager = workspaces.WorkspaceManager(str(tmp_path))
+    workspace = manager.create()
+    other = manager.create()
+    assert manager.start_job(workspace)
+    assert not manager.start_job(workspace)
+    assert manager.start_job(other)
+    assert workspace.active == 1 and not manager.delete(workspace.id)
+    manager.finish_job(workspace)
+    assert workspace.active == 0 and manager.start_job(workspace)
@@ -0,0 +1,62 @@
+import numpy as np
+
+import z_gating
+
+def organ_volume(num_slices=40, organ=slice(18, 24)):
+    volume = np.zeros((num_slices, 4, 4, 1), dtype=np.float32)
+    volume[organ] = 1
+    return volume
+
+class CountingModel:
+    #probability equals the input, so the organ is found exactly where it is
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, slices, progress):
+        self.calls.append(len(slices))
+        if progress is not None:
+            progress(len(slices))
+        return slices.copy()
+
+def test_gating_stride():
+    assert z_gating.gating_stride('Brainstem', 2.5) == 4
+    assert z_gating.gating_stride('Brainstem', 3.0) == 3
+    assert z_gating.gating_stride('Cochlea L', 3.0) == 1
+    assert z_gating.gating_stride('Brain', 1.0) == 1
+    assert z_gating.gating_stride('Brainstem', 0) == 1
+
+def test_coarse_pass_and_candidate_slab():
+    model = CountingModel()
+    coarse_index, coarse, found = z_gating.coarse_pass(model, organ_volume(), 4)
+    assert list(coarse_index) == list(range(0, 40, 4))
+    assert list(found) == [20]
+    assert z_gating.candidate_slab(found, 4, 2, 40) == (14, 27)
+    assert z_gating.candidate_slab(np.array([0, 36]), 4, 2, 40) == (0, 40)
+
+def test_gated_prediction_matches_full_prediction():
+    volume = organ_volume()
+    model = CountingModel()
+    done = []
+    prediction, passes = z_gating.gated_predict(model, volume, 4, margin=2, progress=done.append)
+    assert np.array_equal(prediction, model(volume, None))
+    assert passes == 10 + 10 #coarse slices plus the rest of slab 14-26
+    assert done[-1] == len(volume)
+
+def test_nothing_found_predicts_every_slice():
+    volume = np.zeros((40, 4, 4, 1), dtype=np.float32)
+    model = CountingModel()
+    prediction, passes = z_gating.gated_predict(model, volume, 4)
+    assert model.calls == [10, 40]
+    assert passes == 50
+    assert prediction.shape == volume.shape
+
+def test_below_coarse_threshold_is_not_found():
+    volume = organ_volume() * z_gating.COARSE_THRESHOLD
+    prediction, passes = z_gating.gated_predict(CountingModel(), volume, 4)
+    assert passes == 50
+
+def test_stride_one_and_short_volumes_are_not_gated():
+    model = CountingModel()
+    assert z_gating.gated_predict(model, organ_volume(), 1)[1] == 40
+    assert z_gating.gated_predict(model, organ_volume(6, slice(2, 3)), 4)[1] == 6
+    assert model.calls == [40, 6]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked, resumable file uploads.
+
+Protocol, per file:
+    GET  /api/uploads/<filename>            -> {"size", "received", "complete"}
+    PUT  /api/uploads/<filename>?offset=N&size=S
+         body is the raw chunk, X-Chunk-SHA256 header holds its SHA-256 hex digest
+    POST /api/uploads/<filename>/complete?sha256=<digest of the whole file>
+
+Chunks may arrive in any order and chunks of different files are written at the
+same time. "received" is the length of the contiguous prefix on disk, so after
+a dropped connection the client resumes by sending from that offset. Partial
+files live in the workspace's partial folder next to a small JSON file holding
+the received byte ranges, so an upload can also be resumed after a restart.
+Completed files are checksummed and moved into the upload folder. The size of
+a file is fixed by its first chunk and may not exceed the manager's max_size,
+the partial file is allocated to that size up front.
+"""
+import os
+import json
+import hashlib
+import threading
+
+HASH_BLOCK = 1024*1024
+MAX_FILE_SIZE = 512*1024*1024 #CT slices are well under a megabyte, anything near this is not a single DICOM file
+
+class ChunkError(Exception):
+    pass
+
+class FileTooLarge(ChunkError):
+    pass
+
+def merge_ranges(ranges, start, end):
+    #ranges is a sorted list of non-overlapping [start, end) pairs
+    merged = []
+    for a, b in sorted(ranges + [[start, end]]):
+        if len(merged) > 0 and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return merged
+
+class UploadSession:
+    def __init__(self, path, size):
+        self.path = path
+        self.meta_path = path + '.json'
+        self.size = size
+        self.ranges = []
+        self.lock = threading.Lock()
+        if os.path.exists(self.meta_path) and os.path.exists(self.path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.size = meta['size']
+            self.ranges = meta['ranges']
+        else:
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+            self.save_meta()
+
+    def save_meta(self):
+        with open(self.meta_path, 'w') as f:
+            json.dump({'size':self.size, 'ranges':self.ranges}, f)
+
+    def received(self):
+        if len(self.ranges) == 0 or self.ranges[0][0] != 0:
+            return 0
+        return self.ranges[0][1]
+
+    def complete(self):
+        return self.received() == self.size
+
+    def write(self, offset, data):
+        if offset < 0 or offset + len(data) > self.size:
+            raise ChunkError("Chunk [{}, {}) is outside the file size {}.".format(offset, offset + len(data), self.size))
+        with self.lock: #one writer per file, different files are written concurrently
+            with open(self.path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            self.ranges = merge_ranges(self.ranges, offset, offset + len(data))
+            self.save_meta()
+
+    def status(self):
+        return {'size':self.size, 'received':self.received(), 'complete':self.complete()}
+
+class UploadManager:
+    def __init__(self, max_size=MAX_FILE_SIZE):
+        self.max_size = max_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, workspace, filename, size=None):
+        """
+        Returns the upload session of filename in workspace, starting one if size is
+        given. Returns None if there is no upload in progress and size is None.
+        """
+        if size is not None and (size < 0 or size > self.max_size):
+            raise FileTooLarge("File size must be between 0 and {} bytes, got {}.".format(self.max_size, size))
+        os.makedirs(workspace.partial_folder, exist_ok=True)
+        path = os.path.join(workspace.partial_folder, filename)
+        with self.lock:
+            session = self.sessions.get(path)
+            if session is not None and not os.path.exists(path): #workspace was cleaned up under it
+                session = None
+            if session is None and (size is not None or os.path.exists(path + '.json')):
+                session = UploadSession(path, size)
+                self.sessions[path] = session
+            elif session is not None and size is not None and size != session.size:
+                raise ChunkError("Upload of {} was started with size {}, not {}.".format(filename, session.size, size))
+            return session
+
+    def write_chunk(self, workspace, filename, offset, size, data, checksum=None):
+        if checksum is not None and hashlib.sha256(data).hexdigest() != checksum.lower():
+            raise ChunkError("Chunk checksum mismatch at offset {}.".format(offset))
+        session = self.session(workspace, filename, size)
+        if session is None:
+            raise ChunkError("The first chunk of {} must give the file size.".format(filename))
+        session.write(offset, data)
+        return session.status()
+
+    def finish(self, workspace, filename, checksum=None):
+        """
+        Verifies the whole file against checksum and moves it into the upload folder.
+        """
+        session = self.session(workspace, filename)
+        if session is None:
+            raise ChunkError("No upload in progress for {}.".format(filename))
+        with session.lock:
+            if not session.complete():
+                raise ChunkError("Upload of {} is incomplete, {} of {} bytes received.".format(filename, session.received(), session.size))
+            if checksum is not None:
+                digest = hashlib.sha256()
+                with open(session.path, 'rb') as f:
+                    for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                        digest.update(block)
+                if digest.hexdigest() != checksum.lower():
+                    raise ChunkError("File checksum mismatch for {}, resend it.".format(filename))
+            os.replace(session.path, os.path.join(workspace.upload_folder, filename))
+            os.remove(session.meta_path)
+        with self.lock:
+            self.sessions.pop(session.path, None)
+        return {'size':session.size, 'received':session.size, 'complete':True}
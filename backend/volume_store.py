@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Self-describing container for a processed patient volume.
+
+Layout of the file:
+    MAGIC (8 bytes)
+    header length (4 bytes, little-endian unsigned int)
+    JSON header - shape, dtype, slice heights, spacing, origin, series UIDs
+    padding up to a 64-byte boundary
+    raw volume data (C order)
+
+The volume is written once at ingest and read back with np.memmap, so loading is
+near-instant and several workers reading the same patient share the OS page cache
+instead of each holding their own copy. Replaces patient_volume.npy + slice_height_map.pckl.
+"""
+import json
+import struct
+import numpy as np
+
+MAGIC = b"HNVOL\x00\x01\x00"
+ALIGNMENT = 64
+
+def save_volume(filepath, volume, heightlist, spacing, origin, series_uids):
+    """
+    Parameters
+    ----------
+    filepath : str
+        Destination of the container file.
+    volume : np.array
+        Stacked patient images, shape (slices, rows, cols, 1). Stored as int16.
+    heightlist : list
+        Slice heights corresponding positionally to the slices in volume.
+    spacing : list
+        [row spacing, column spacing, slice thickness] in mm.
+    origin : list
+        Real-space [x, y, z] coordinate of the first voxel in mm.
+    series_uids : dict
+        StudyInstanceUID, SeriesInstanceUID and FrameOfReferenceUID of the series.
+    """
+    volume = np.ascontiguousarray(volume, dtype=np.int16)
+    header = {"shape":list(volume.shape),
+              "dtype":volume.dtype.str,
+              "heightlist":[float(h) for h in heightlist],
+              "spacing":[float(s) for s in spacing],
+              "origin":[float(o) for o in origin],
+              "series_uids":{k:str(v) for k,v in series_uids.items()}}
+    headerbytes = json.dumps(header).encode("utf-8")
+    prefix = len(MAGIC) + 4 + len(headerbytes)
+    padding = (ALIGNMENT - prefix % ALIGNMENT) % ALIGNMENT
+    with open(filepath, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(headerbytes) + padding))
+        f.write(headerbytes)
+        f.write(b" " * padding) #whitespace padding keeps the header valid JSON
+        f.write(volume.tobytes())
+
+def read_header(filepath):
+    with open(filepath, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a patient volume container." % filepath)
+        headerlength = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(headerlength).decode("utf-8"))
+    header["offset"] = len(MAGIC) + 4 + headerlength
+    return header
+
+def load_volume(filepath):
+    """
+    Returns
+    -------
+    volume : np.memmap
+        Read-only memory-mapped view of the stored volume. Take a copy before modifying it.
+    header : dict
+        Metadata stored alongside the volume (heightlist, spacing, origin, series_uids).
+    """
+    header = read_header(filepath)
+    volume = np.memmap(filepath, dtype=np.dtype(header["dtype"]), mode="r",
+                       offset=header["offset"], shape=tuple(header["shape"]))
+    return volume, header
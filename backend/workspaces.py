@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Per-job isolated workspaces.
+
+Every patient gets its own folder under the workspace root holding its uploads,
+ingest artifacts (patient_volume.vol, series_metadata.json) and generated
+structure sets, so concurrent jobs can never overwrite each other's files.
+
+Workspaces are removed by garbage collection when they have been idle longer
+than the retention period, and the oldest idle workspaces are removed first
+whenever total disk usage is above the quota. Workspaces with a running job
+are never collected. Collection runs on a background thread (start_collector),
+never on the request path, and only re-measures workspaces used since their
+last measurement.
+"""
+import os
+import re
+import time
+import uuid
+import shutil
+import logging
+import threading
+logger = logging.getLogger(name="Workspaces")
+
+VALID_ID = re.compile(r'^[0-9a-f]{32}$|^default$')
+
+class Workspace:
+    def __init__(self, workspace_id, root):
+        self.id = workspace_id
+        self.root = root
+        self.upload_folder = os.path.join(root,'upload')
+        self.output_folder = os.path.join(root,'output')
+        self.partial_folder = os.path.join(root,'partial') #chunked uploads in progress, see uploads.py
+        self.last_used = time.time()
+        self.active = 0 #number of jobs currently using the workspace
+        self.busy = False #a job, validation or archive ingest is writing the patient volume, see start_job
+        self.usage = 0 #bytes found by the last disk_usage walk
+        self.measured = None #time of that walk
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def disk_usage(self, cached=False):
+        """
+        Bytes held by the workspace. With cached=True the last measurement is reused
+        unless the workspace was used after it.
+        """
+        if cached and self.measured is not None and self.measured >= self.last_used:
+            return self.usage
+        measured = time.time()
+        total = 0
+        for folder, dirs, files in os.walk(self.root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(folder,name))
+                except OSError:
+                    pass #file removed while walking
+        self.usage = total
+        self.measured = measured
+        return total
+
+class WorkspaceManager:
+    def __init__(self, root, retention=24*3600, quota=20*1024**3):
+        """
+        Parameters
+        ----------
+        root : str
+            Folder under which every workspace is created.
+        retention : float
+            Seconds a workspace may sit idle before it is collected.
+        quota : int
+            Total bytes all workspaces may use before the oldest idle ones are collected.
+        """
+        self.root = root
+        self.retention = retention
+        self.quota = quota
+        self.workspaces = {}
+        self.lock = threading.Lock()
+        self.on_delete = [] #callables taking the workspace ID, run whenever a workspace is removed
+        self.stopped = threading.Event()
+        if not os.path.exists(root):
+            os.makedirs(root)
+        for name in os.listdir(root): #adopt workspaces left over from a previous run so they are collected too
+            path = os.path.join(root,name)
+            if os.path.isdir(path) and VALID_ID.match(name):
+                workspace = Workspace(name,path)
+                workspace.last_used = os.path.getmtime(path)
+                self.workspaces[name] = workspace
+
+    def create(self, workspace_id=None):
+        if workspace_id is None:
+            workspace_id = uuid.uuid4().hex
+        with self.lock:
+            if workspace_id in self.workspaces:
+                return self.workspaces[workspace_id]
+            workspace = Workspace(workspace_id,os.path.join(self.root,workspace_id))
+            os.makedirs(workspace.upload_folder,exist_ok=True)
+            os.makedirs(workspace.output_folder,exist_ok=True)
+            self.workspaces[workspace_id] = workspace
+        return workspace
+
+    def get(self, workspace_id):
+        if workspace_id is None or not VALID_ID.match(workspace_id):
+            return None
+        with self.lock:
+            workspace = self.workspaces.get(workspace_id)
+        if workspace is not None:
+            workspace.touch()
+        return workspace
+
+    def acquire(self, workspace):
+        with self.lock:
+            workspace.active += 1
+            workspace.touch()
+
+    def release(self, workspace):
+        with self.lock:
+            workspace.active -= 1
+            workspace.touch()
+
+    def start_job(self, workspace):
+        """
+        Acquires workspace for work that writes its patient volume or structure sets.
+        Returns False if such work is already running there, two of them would read and
+        write the same files at the same time.
+        """
+        with self.lock:
+            if workspace.busy:
+                return False
+            workspace.busy = True
+            workspace.active += 1
+            workspace.touch()
+        return True
+
+    def finish_job(self, workspace):
+        with self.lock:
+            workspace.busy = False
+            workspace.active -= 1
+            workspace.touch()
+
+    def delete(self, workspace_id):
+        with self.lock:
+            workspace = self.workspaces.get(workspace_id)
+            if workspace is None or workspace.active > 0:
+                return False
+            del self.workspaces[workspace_id]
+        shutil.rmtree(workspace.root,ignore_errors=True)
+        for callback in self.on_delete:
+            callback(workspace_id)
+        return True
+
+    def collect(self):
+        """
+        Removes idle workspaces past the retention period, then removes the oldest idle
+        workspaces until total usage is under the quota. Returns the IDs removed.
+        """
+        now = time.time()
+        removed = []
+        with self.lock:
+            idle = sorted([w for w in self.workspaces.values() if w.active == 0], key=lambda w: w.last_used)
+        for workspace in idle:
+            if now - workspace.last_used > self.retention and self.delete(workspace.id):
+                removed.append(workspace.id)
+        with self.lock:
+            remaining = list(self.workspaces.values())
+        usage = {w.id:w.disk_usage(cached=True) for w in remaining}
+        total = sum(usage.values())
+        for workspace in idle:
+            if total <= self.quota:
+                break
+            if workspace.id in removed:
+                continue
+            if self.delete(workspace.id):
+                removed.append(workspace.id)
+                total -= usage.get(workspace.id,0)
+        if len(removed) > 0:
+            logger.info("Collected %d workspaces: %s", len(removed), ", ".join(removed))
+        return removed
+
+    def start_collector(self, interval=300):
+        """
+        Runs collect every interval seconds on a daemon thread until stop is called.
+        """
+        def run():
+            while not self.stopped.wait(interval):
+                try:
+                    self.collect()
+                except Exception:
+                    logger.exception("Workspace collection failed.")
+        thread = threading.Thread(target=run,name="workspace-gc",daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Anatomical z-range gating of per-OAR inference.
+
+Most OARs occupy a narrow band of a head and neck scan, yet each model used to be
+run on every slice. gated_predict first runs the OAR's model on a coarse subset
+of slices (every stride-th slice, the stride being shorter than the organ's
+smallest craniocaudal extent so the organ cannot fall between two samples). The
+slices where the coarse pass finds the organ, widened by the stride and a safety
+margin, form the candidate slab, and only the remaining slices inside that slab
+are predicted. Slices outside the slab are left at zero probability.
+
+If the coarse pass finds nothing the whole volume is predicted, so gating never
+drops an organ the full pass would have found.
+"""
+import numpy as np
+
+from oar_config import Z_GATING_STRIDE_MM
+
+COARSE_THRESHOLD = 0.1 #lowest contour threshold for gated maps (enforced by /api/recontour), anything below cannot become part of a contour
+MARGIN_MM = 5.0 #extra distance kept on both ends of the candidate slab
+
+def gating_stride(OAR, slicethickness):
+    """
+    Number of slices between coarse samples for OAR, 1 (no gating) for OARs without
+    a configured stride or when the slice thickness is unknown.
+    """
+    if OAR not in Z_GATING_STRIDE_MM or slicethickness <= 0:
+        return 1
+    return max(1, int(Z_GATING_STRIDE_MM[OAR] // slicethickness))
+
+def coarse_pass(predict, volume, stride, progress=None):
+    """
+    Predicts every stride-th slice. Returns the indices of those slices, their
+    probability maps and the indices of the ones where the organ was found.
+    """
+    coarse_index = np.arange(0, len(volume), stride)
+    coarse = predict(volume[coarse_index], progress)
+    found = coarse_index[coarse.reshape(len(coarse), -1).max(axis=1) > COARSE_THRESHOLD]
+    return coarse_index, coarse, found
+
+def candidate_slab(found, stride, margin, num_slices):
+    #organ may extend up to one stride past the outermost hits, plus the margin
+    return max(0, found.min() - stride - margin), min(num_slices, found.max() + stride + margin + 1)
+
+def gated_predict(predict, volume, stride, margin=1, progress=None):
+    """
+    Parameters
+    ----------
+    predict : callable
+        predict(slices, progress) returns the probability map of the given slices.
+    volume : np.array
+        Windowed patient volume, shape (slices, rows, cols, 1).
+    stride : int
+        Slices between coarse samples. 1 predicts every slice.
+    margin : int
+        Slices added to both ends of the candidate slab on top of the stride.
+    progress : callable, optional
+        Called with the number of slices done, counted over the whole volume.
+
+    Returns
+    -------
+    prediction : np.array
+        Probability map for every slice of volume.
+    passes : int
+        Number of slices that went through the network.
+    """
+    num_slices = len(volume)
+    if stride <= 1 or num_slices < 2 * stride:
+        return predict(volume, progress), num_slices
+    coarse_index, coarse, found = coarse_pass(predict, volume, stride, progress)
+    if len(found) == 0:
+        return predict(volume, progress), num_slices + len(coarse_index)
+    start, end = candidate_slab(found, stride, margin, num_slices)
+    fine_index = np.array([i for i in range(start, end) if i % stride != 0], dtype=int)
+    prediction = np.zeros((num_slices,) + coarse.shape[1:], dtype=coarse.dtype)
+    prediction[coarse_index] = coarse
+    if len(fine_index) > 0:
+        fine_progress = None if progress is None else (lambda done: progress(len(coarse_index) + done))
+        prediction[fine_index] = predict(volume[fine_index], fine_progress)
+    if progress is not None:
+        progress(num_slices) #skipped slices count as done
+    return prediction, len(coarse_index) + len(fine_index)
@@ -4,6 +4,7 @@ import TextareaAutosize from '@mui/base/TextareaAutosize';
 import axios from 'axios';
 import React, { useState } from 'react';
 import { createTheme } from '@mui/material/styles';
+import { getWorkspace, workspaceUrl } from '../services/workspace';
 
 const theme = createTheme({
     
@@ -22,52 +23,64 @@ function AdvanceButton() {
     const [buttonMode,setButtonMode] = useState("Validate")
     const [activeLoading, setActiveLoading] = useState(false)
     const [currentStatus, setCurrentStatus] = useState("Pending file upload and validation to begin neural network inference.")
-    const [fileID, setFileID] = useState("")
+    const [downloadPath, setDownloadPath] = useState("")
 
     function advance() {
-        var CNN_threadID = ""
-        var interval_ID = 0
         if (buttonMode == "Validate") {
             setActiveLoading(true)
-            axios.get("http://localhost:5000/api/files/validate")
+            getWorkspace()
+            .then((workspace_id) => axios.get(workspaceUrl("/api/files/validate",workspace_id)))
             .then((res) => {
                 setCurrentStatus(res.data)
                 setActiveLoading(false)
                 setButtonMode("Process")
             })
-            .catch((res) => {
-                setCurrentStatus(res.data)
+            .catch((err) => {
+                setCurrentStatus(err.response ? err.response.data : "An error has occurred.")
                 setActiveLoading(false)
                 setButtonMode("Validate")
             })
         } else if (buttonMode == "Process") {
             setActiveLoading(true)
-            axios.get('http://localhost:5000/api/threads/create?threadtype=neural')
+            getWorkspace()
+            .then((workspace_id) => axios.get(workspaceUrl('/api/inference',workspace_id)))
             .then((res) => {
-                CNN_threadID = res.data
-                interval_ID = setInterval(progressUpdate,1000,CNN_threadID)
-            }).then(() => {
-                axios.get('http://localhost:5000/api/inference?thread_id=' + CNN_threadID)
-                .then((res) => {
-                    setFileID(res.data)
-                    setActiveLoading(false)
-                    clearInterval(interval_ID)
+                //inference runs as a background job, the server pushes its progress so nothing is polled
+                var events = new EventSource('http://localhost:5000/api/jobs/' + res.data.job_id + '/events')
+                events.addEventListener('stage', (e) => setCurrentStatus(JSON.parse(e.data).progress))
+                events.addEventListener('progress', (e) => setCurrentStatus(describeProgress(JSON.parse(e.data))))
+                events.addEventListener('state', (e) => {
+                    var job = JSON.parse(e.data)
+                    if (job.state == "finished") {
+                        events.close()
+                        setCurrentStatus("Structure set file ready for download.")
+                        setDownloadPath(job.result.download) //already names the workspace and file
+                        setActiveLoading(false)
+                    } else if (job.state == "failed") {
+                        events.close()
+                        setCurrentStatus("An error has occurred: " + job.error)
+                        setActiveLoading(false)
+                        setButtonMode("Validate")
+                    }
                 })
-            }).catch(() => {
-                setCurrentStatus("An error has occurred.")
+            }).catch((err) => {
+                setCurrentStatus(err.response ? err.response.data : "An error has occurred.") //e.g. 409 while a job is running
+                setActiveLoading(false)
                 setButtonMode("Validate")
             })
             setButtonMode("Download")
         } else if (buttonMode == "Download") {
-            window.open("http://localhost:5000/api/files/download?file_id=" + fileID)
+            window.open("http://localhost:5000" + downloadPath)
         }
     }
 
-    function progressUpdate(CNN_threadID) {
-        axios.get('http://localhost:5000/api/threads/' + CNN_threadID + "/progress")
-        .then((res) => {
-            setCurrentStatus(res.data)
-        }).catch(() => setCurrentStatus("Error has occurred."))
+    function describeProgress(data) {
+        var status = "Working on " + data.OAR + " (" + (data.OAR_index + 1) + " of " + data.OAR_count + "), " +
+                     data.slices_done + " of " + data.slice_count + " slices done."
+        if (data.eta != null) {
+            status += " About " + Math.round(data.eta) + " seconds left."
+        }
+        return status
     }
 
     return (
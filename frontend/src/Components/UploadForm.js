@@ -2,6 +2,9 @@ import React, { useState, useEffect } from 'react'
 import { Button, IconButton, LinearProgress } from '@mui/material';
 import Input from '@mui/material/Input';
 import axios from 'axios'
+import { getWorkspace, workspaceUrl } from '../services/workspace'
+
+const UPLOAD_CONCURRENCY = 4 //file uploads in flight at once
 
 function UploadForm() {
 
@@ -9,68 +12,59 @@ function UploadForm() {
     const [progress,setProgress] = useState(0)
     const [uploading,setUploading] = useState(false)
 
-    useEffect(() => cleanUp(),[])
+    useEffect(() => updateFileCount(),[]) //the page's workspace is new, other users' files are never touched
 
     function updateFileCount() {
-        axios.get("http://localhost:5000/api/files",{
+        getWorkspace().then((workspace_id) => axios.get(workspaceUrl("/api/files",workspace_id),{
         headers: {"accepts":"application/json"}
-        }).then(res => {setDCMfiles(res.data.files)      
-        })
-    }
-
-    function cleanUp() {
-        axios.delete("http://localhost:5000/api/cleanup", {
-        'Content-Type': 'application/json'
+        })).then(res => {setDCMfiles(res.data.files)      
         })
-        .then((res) => console.log(res.data))
-        .catch((res) => console.log(res.data))
-        .then(updateFileCount())
     }
 
     function createThread() {}
 
 
     function handleSubmit(event) {
-        const form = event.currentTarget
-        var formData = new FormData();
-        var upload_thread_id = '0'
-        var interval_id = 0
         event.preventDefault();
-        for (let step = 0; step < event.target.dicom_files.files.length; step++) {
-            formData.append(step,event.target.dicom_files.files[step])
-        }
+        const files = Array.from(event.target.dicom_files.files)
+        const total = files.length
+        var done = 0
+        setProgress(0)
         setUploading(true)
-        axios.get('http://localhost:5000/api/threads/create?threadtype=upload')
-        .then((res) => {
-            upload_thread_id = res.data
+        Promise.all([axios.get('http://localhost:5000/api/threads/create?threadtype=upload'), getWorkspace()])
+        .then(([res, workspace_id]) => {
+            const upload_thread_id = res.data
             console.log("Upload thread ID:" + upload_thread_id)
-            interval_id = setInterval(progressUpdate, 100, upload_thread_id)
-        }).then(() => {
-            axios.post('http://localhost:5000/api/files?thread_id=' + upload_thread_id,
-                            formData, {
-                                headers: {
-                                    'Content-Type': 'multipart/form-data'
+            //one request per file: the server only sees a multipart body once all of it has arrived,
+            //separate requests let it decode each slice while the next ones are still being sent
+            function uploadNext() {
+                const file = files.shift()
+                if (file === undefined) {
+                    return Promise.resolve()
+                }
+                var formData = new FormData();
+                formData.append(0,file)
+                return axios.post(workspaceUrl('/api/files?thread_id=' + upload_thread_id,workspace_id),
+                                formData, {
+                                    headers: {
+                                        'Content-Type': 'multipart/form-data'
+                                    }
                                 }
-                            }
-            ).then((res) => {
-                console.log("Files successfully uploaded");
-                clearInterval(interval_id)
-            }).catch((err) => console.log("Failed to upload"))
-            .then(() => {
-                setUploading(false)
-                updateFileCount()
-            }) 
+                ).then(() => {
+                    done += 1
+                    setProgress(Math.round(done / total * 100))
+                    return uploadNext()
+                })
+            }
+            return Promise.all(Array.from({length: UPLOAD_CONCURRENCY}, uploadNext))
+        }).then(() => console.log("Files successfully uploaded"))
+        .catch((err) => console.log("Failed to upload"))
+        .then(() => {
+            setUploading(false)
+            updateFileCount()
         })
     }
 
-    function progressUpdate(upload_thread_id) {
-        axios.get('http://localhost:5000/api/threads/' + upload_thread_id + "/progress")
-        .then((res) => {
-            console.log(res.data)
-            setProgress(parseInt(res.data))
-        }).catch(() => setProgress(100))
-    }
-
     return (
         <div className="uploadform">
             <form onSubmit={handleSubmit}>
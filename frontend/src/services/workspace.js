@@ -0,0 +1,18 @@
+import axios from 'axios'
+
+const API = 'http://localhost:5000'
+
+//every page load works in its own server workspace, so users never see or overwrite each other's files
+let workspace = null
+
+export function getWorkspace() {
+    if (workspace == null) {
+        workspace = axios.post(API + '/api/workspaces').then((res) => res.data.workspace_id)
+    }
+    return workspace
+}
+
+//URL of a backend endpoint with the workspace ID of this page added to its query
+export function workspaceUrl(path, workspace_id) {
+    return API + path + (path.includes('?') ? '&' : '?') + 'workspace_id=' + workspace_id
+}
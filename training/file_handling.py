@@ -7,6 +7,9 @@ Created on Mon May 24 21:00:40 2021
 
 import os
 import sys
+import itertools
+import multiprocessing
+import concurrent.futures
 import logging
 logger = logging.getLogger(name="Files")
 
@@ -14,6 +17,44 @@ import pydicom
 import numpy as np
 import cv2
 
+HEADER_TAGS = ["Modality","SliceLocation","PatientID"]
+
+def scan_headers(folderpath,tags=HEADER_TAGS):
+    """
+    Parameters
+    ----------
+    folderpath : str
+        Path to the folder that holds the DICOM files.
+    tags : list, optional
+        DICOM keywords to parse from each header. The default is HEADER_TAGS.
+
+    Returns
+    -------
+    headerdict : dict
+        Dictionary keyed by Modality. Each entry is a list of (filepath, header) tuples sorted by slice height.
+    skippedfiles : int
+        Number of non-DICOM files encountered.
+
+    Reading stops before the pixel data and only the requested tags are parsed, so the files can be classified and
+    ordered without a full read. Pixel data is then only loaded for the files that are actually kept.
+    """
+    headerdict = {}
+    skippedfiles = 0
+    for root, dirs, files in os.walk(folderpath): #we want to classify every dicom file in directory
+        for name in files:
+            if not name.endswith(".dcm"):
+                skippedfiles += 1
+                continue
+            filepath = os.path.join(root,name)
+            header = pydicom.read_file(filepath,stop_before_pixels=True,specific_tags=tags)
+            modality = header.get("Modality")
+            if modality not in headerdict:
+                headerdict[modality] = []
+            headerdict[modality].append((filepath,header))
+    for modality in headerdict:
+        headerdict[modality].sort(key=lambda item: item[1].get("SliceLocation",0))
+    return headerdict, skippedfiles
+
 def get_files(folderpath,get_rtstruct=False):
     """
     Parameters
@@ -26,34 +67,34 @@ def get_files(folderpath,get_rtstruct=False):
     filelist : list
         List of loaded DICOM files which will be used to iteratively build the input array
 
+    Files are classified with a header-only pass first (see scan_headers), so only the CT images and the
+    structure set are read in full.
     """
-    filelist = []
-    totalfiles = 0
-    skippedfiles = 0
+    headerdict, skippedfiles = scan_headers(folderpath)
+    totalfiles = skippedfiles + sum(len(entries) for entries in headerdict.values())
     structureset = None
-    for root, dirs, files in os.walk(folderpath): #we want to extract every dicom file in directory
-        for name in files:
-            if name.endswith(".dcm"):
-                filepath = os.path.join(root,name)
-                dicomfile = pydicom.read_file(filepath) #will load each DICOM file in turn
-                if dicomfile.Modality == "CT":
-                    filelist.append(dicomfile)
-                elif dicomfile.Modality == "RTSTRUCT":
-                    if not isinstance(structureset,type(None)):
-                        raise Exception("Invalid input data files - multiple structure sets in %s." % root)
-                    structureset = dicomfile
-                else:
-                    skippedfiles += 1
-            else:
-                skippedfiles += 1
-            totalfiles += 1
+    rtstructs = headerdict.get("RTSTRUCT",[])
+    if len(rtstructs) > 1:
+        raise Exception("Invalid input data files - multiple structure sets in %s." % os.path.dirname(rtstructs[1][0]))
+    if len(rtstructs) == 1:
+        structureset = pydicom.read_file(rtstructs[0][0])
+    filelist = [pydicom.read_file(filepath) for filepath, header in headerdict.get("CT",[])]
+    for modality in headerdict:
+        if modality not in ("CT","RTSTRUCT"):
+            skippedfiles += len(headerdict[modality])
     logger.info("Input folder processed. %d total files were found. %d were invalid and were not retained.",totalfiles,skippedfiles)
     if get_rtstruct == True:
         return filelist,structureset
     else:
         return filelist
 
-def build_array(filelist,image_size=256,pixel_size=1.0):
+def _process_slice(ds,image_size,pixel_size):
+    #module-level so it can be pickled out to worker processes
+    image = process_image(ds,image_size,pixel_size)
+    sliceheight = round(ds.SliceLocation * 4) / 4
+    return sliceheight, image
+
+def build_array(filelist,image_size=256,pixel_size=1.0,workers=1):
     """
     Parameters
     ----------
@@ -63,6 +104,8 @@ def build_array(filelist,image_size=256,pixel_size=1.0):
         Number of pixels along each axis of the image. The default is 256.
     pixel_size : float, optional
         Size in mm of x/y dimensions of pixels. The default is 1.
+    workers : int, optional
+        Number of processes used to decode and resample slices. The default is 1 (serial).
 
     Returns
     -------
@@ -74,6 +117,10 @@ def build_array(filelist,image_size=256,pixel_size=1.0):
     The function creates a dictionary object to associate the z-axis SliceLocation with the image. This allows the images to be
     ordered correctly regardless of what order they were loaded in. The corresponding height list will be retained as it will be necessary
     for building the eventual DICOM structure set files - contours are stored as real-space coordinates.
+
+    With workers > 1 the decoding and process_image work is spread across a process pool. Results are collected in the same order
+    as the serial loop, so the output is identical. Workers are started with spawn, so scripts that use this must guard their entry
+    point with if __name__ == "__main__".
     """
     holding_dict = {}
     heightlist = []
@@ -81,9 +128,17 @@ def build_array(filelist,image_size=256,pixel_size=1.0):
     for ds in filelist:
         if ds.SliceLocation != ds.ImagePositionPatient[2]:
             logger.warning("File detected where SliceLocation does not match ImagePositionPatient coordinate. Double check results to ensure contour alignment.")
-        image = process_image(ds,image_size,pixel_size)
-        sliceheight = round(ds.SliceLocation * 4) / 4
-        holding_dict[sliceheight] = image
+    if workers is not None and workers > 1 and len(filelist) > 1:
+        chunksize = max(1, len(filelist) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context("spawn")) as pool: #same start method as the backend on every platform
+            results = pool.map(_process_slice, filelist, itertools.repeat(image_size),
+                               itertools.repeat(pixel_size), chunksize=chunksize)
+            for sliceheight, image in results:
+                holding_dict[sliceheight] = image
+    else:
+        for ds in filelist:
+            sliceheight, image = _process_slice(ds,image_size,pixel_size)
+            holding_dict[sliceheight] = image
     for height in sorted(holding_dict.keys()):
         heightlist.append(height)
         array.append(holding_dict[height])
@@ -172,6 +227,7 @@ def apply_window_level(image, windowwidth, windowlevel, normalize = False):
 
     upperlimit = windowlevel + (windowwidth / 2)
     lowerlimit = windowlevel - (windowwidth / 2)
+    image = np.array(image) #clip a copy so the caller's volume is never modified in place
     image[image > upperlimit] = upperlimit
     image[image < lowerlimit] = lowerlimit
 
@@ -180,7 +236,25 @@ def apply_window_level(image, windowwidth, windowlevel, normalize = False):
         image = (image-lowerlimit) / (upperlimit - lowerlimit)
 
     return image
-    
+
+class WindowCache:
+    """
+    Builds each distinct window/level volume of a patient once and hands the same
+    read-only array to every OAR that uses that window.
+    """
+    def __init__(self, volume, filters):
+        self.volume = volume
+        self.filters = filters #dictionary of name -> [window, level]
+        self.windowed = {}
+
+    def get(self, name):
+        if name not in self.windowed:
+            windowwidth, windowlevel = self.filters[name]
+            windowed = apply_window_level(self.volume, windowwidth, windowlevel)
+            windowed.setflags(write=False)
+            self.windowed[name] = windowed
+        return self.windowed[name]
+
 def crop_center(img,cropto):      #function used to trim images to standardized size if too big - trims to center
     y,x = img.shape
     startx = x//2-(cropto//2)
@@ -15,18 +15,15 @@ import logging
 logger = logging.getLogger(name="Main")
 logger.setLevel(level="WARNING")
 
-import keras
-import tensorflow as tf
 import numpy as np
-from keras import optimizers
 
 import file_handling
 import createdicomfile
-from model.UNet import Build_UNet
-from model.losses import bce_dice_loss, dice_coef
+from weight_prefetch import WeightPrefetcher, read_hdf5_weights, set_layer_weights
 
 
 patientfolder = r"F:\DICOMdata\RoswellData\017_111" #<--- Update this variable to the path to the folder that holds the patient study
+INFERENCE_BACKEND = "keras" #set to "onnx" to use ONNX Runtime on CPU (export the models first with onnx_inference.py), or "onnx_int8" for the quantized models from quantization.py
 
 if len(sys.argv) > 1:
     patientfolder = sys.argv[1] #if run in command line, allows path to folder to be passed as an argument to the script
@@ -40,14 +37,21 @@ if not os.path.exists(patientfolder):
 filelist = file_handling.get_files(patientfolder)
 inputarray, heightlist = file_handling.build_array(filelist)
 
-#inputarray is now retained as the base array. For each OAR a copy will be created for the window/level filtering
+#inputarray is now retained as the base array. Each window/level filter is applied to it once, see WindowCache
 
 #================================================
 #        Initialize the model
 #================================================
-model = Build_UNet()
-model.compile(optimizer=optimizers.Adam(lr=1e-5),
-                  loss=bce_dice_loss, metrics=[dice_coef])
+if INFERENCE_BACKEND in ("onnx","onnx_int8"):
+    from onnx_inference import OnnxUNet
+    model = OnnxUNet(os.path.join(os.getcwd(),"weights",INFERENCE_BACKEND))
+else:
+    from keras import optimizers
+    from model.UNet import Build_UNet
+    from model.losses import bce_dice_loss, dice_coef
+    model = Build_UNet()
+    model.compile(optimizer=optimizers.Adam(lr=1e-5),
+                      loss=bce_dice_loss, metrics=[dice_coef])
 
 #================================================
 #        Prepare and iterate through OARs
@@ -57,22 +61,31 @@ ROIlist = ["BrachialPlexus","Brain","CochleaL","CochleaR","Larynx","ParotidL","P
 
 filters = {"bone":[2000, 400], "tissue":[400,40],"none":[4500,1000]} #window/level filters
 
+windows = file_handling.WindowCache(inputarray,filters) #each filtered volume is built once and shared by the OARs that use it
+
 wd = os.getcwd()
 
+#the next ROI's weights are read on a background thread while the current ROI is predicted
+if INFERENCE_BACKEND in ("onnx","onnx_int8"):
+    prefetcher = WeightPrefetcher(ROIlist,model.open_session,model.use_session)
+else:
+    prefetcher = WeightPrefetcher(ROIlist,lambda ROI: read_hdf5_weights(os.path.join(wd,"weights/%s.hdf5" % ROI)),
+                                  lambda weights: set_layer_weights(model,weights))
+
 structuresetdata = [] #This is the storage where each successive OAR array will be stored. We later can turn it into a DICOM file.
 for ROI in ROIlist:
-    weightspath = os.path.join(wd,"weights/%s.hdf5" % ROI)
-    model.load_weights(weightspath)
+    prefetcher.load_weights(ROI)
     
     #apply window/level
     if any((ROI=="BrachialPlexus",ROI=="SpinalCord")):
-        model_input = file_handling.apply_window_level(inputarray,filters["bone"][0],filters["bone"][1])
+        model_input = windows.get("bone")
     else:
-        model_input = file_handling.apply_window_level(inputarray,filters["tissue"][0],filters["tissue"][1])
+        model_input = windows.get("tissue")
         
     prediction = model.predict(model_input)
     
     structuresetdata.append([ROI,prediction,heightlist]) #Note that heighlist is identical for each, this is intended
+prefetcher.close()
 
 #================================================
 #        Generate DICOM compliant SS file
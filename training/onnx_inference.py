@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+ONNX Runtime alternative to Keras model.predict for generate_dicom.py.
+
+Export the trained weights once (requires tensorflow, keras and tf2onnx):
+    python onnx_inference.py [weights_folder]
+This writes weights/onnx/<ROI>.onnx for every ROI. Afterwards set INFERENCE_BACKEND
+to "onnx" in generate_dicom.py to run inference without loading TensorFlow.
+"""
+
+import os
+import logging
+logger = logging.getLogger(name="ONNX")
+
+import numpy as np
+import onnxruntime as ort
+
+def export_models(ROIlist,weightsfolder="weights",onnxfolder=None,opset=12):
+    """
+    Parameters
+    ----------
+    ROIlist : list
+        ROI names, each must have a matching <ROI>.hdf5 file in weightsfolder.
+    weightsfolder : str, optional
+        Folder holding the trained Keras weights. The default is "weights".
+    onnxfolder : str, optional
+        Destination folder for the .onnx files. The default is weightsfolder/onnx.
+    """
+    import tensorflow as tf
+    import tf2onnx
+    from model.UNet import Build_UNet
+
+    if onnxfolder is None:
+        onnxfolder = os.path.join(weightsfolder,"onnx")
+    if not os.path.exists(onnxfolder):
+        os.makedirs(onnxfolder)
+    model = Build_UNet()
+    spec = (tf.TensorSpec((None,256,256,1),tf.float32,name="input"),)
+    for ROI in ROIlist:
+        model.load_weights(os.path.join(weightsfolder,"%s.hdf5" % ROI))
+        tf2onnx.convert.from_keras(model,input_signature=spec,opset=opset,
+                                   output_path=os.path.join(onnxfolder,"%s.onnx" % ROI))
+        logger.info("Exported %s to ONNX.",ROI)
+
+class OnnxUNet:
+    """
+    Stand-in for a Keras model in the per-ROI loop: load_weights swaps to the ROI's
+    ONNX session and predict runs it on the CPU in batches.
+    """
+    def __init__(self,onnxfolder=os.path.join("weights","onnx"),batch_size=32):
+        self.onnxfolder = onnxfolder
+        self.batch_size = batch_size
+        self.options = ort.SessionOptions()
+        self.options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = None
+
+    def open_session(self,ROI):
+        #reads and optimizes the model without touching the active session, safe to run on a prefetch thread
+        return ort.InferenceSession(os.path.join(self.onnxfolder,"%s.onnx" % ROI),self.options,
+                                    providers=["CPUExecutionProvider"])
+
+    def use_session(self,session):
+        self.session = session
+
+    def load_weights(self,ROI):
+        self.use_session(self.open_session(ROI))
+
+    def predict(self,volume):
+        inputname = self.session.get_inputs()[0].name
+        outputs = []
+        for start in range(0,len(volume),self.batch_size):
+            batch = np.asarray(volume[start:start+self.batch_size],dtype=np.float32)
+            outputs.append(self.session.run(None,{inputname:batch})[0])
+        return np.concatenate(outputs,axis=0)
+
+if __name__ == "__main__":
+    import sys
+    ROIlist = ["BrachialPlexus","Brain","CochleaL","CochleaR","Larynx","ParotidL","ParotidR","SpinalCord",
+               "BrainStem","SubmandibularL","SubmandibularR"]
+    weightsfolder = sys.argv[1] if len(sys.argv) > 1 else "weights"
+    export_models(ROIlist,weightsfolder)
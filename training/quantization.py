@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+INT8 post-training quantization of the exported ONNX U-Nets, with a validation
+harness that measures how far the int8 contours drift from the float32 ones.
+
+Workflow:
+    1. Export the float32 models with onnx_inference.py (weights/onnx/<ROI>.onnx)
+    2. quantize_models() calibrates on CT slices from a set of representative
+       patient folders and writes weights/onnx_int8/<ROI>.onnx
+    3. validate() runs float32 and int8 on a set of validation patients and
+       reports get_DSC, mean_surface_distance and hausdorff_distance per ROI.
+       If a patient folder holds a structure set with the ROI, both models are
+       also scored against it and the accuracy delta (int8 - float32) is reported.
+    4. install_backend_models() copies the int8 models to backend/weights/onnx_int8
+       under the backend's OAR names (BrainStem.onnx -> Brainstem.onnx, see
+       oar_config.weights_path), where INFERENCE_BACKEND=onnx_int8 loads them.
+
+Run directly:
+    python quantization.py <calibration_root> <validation_root> [backend_int8_folder]
+where each root holds one subfolder per patient, same layout as training.py. The
+models are installed for the backend when the third argument is given.
+"""
+
+import os
+import shutil
+import logging
+logger = logging.getLogger(name="Quantization")
+
+import numpy as np
+import pandas as pd
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+import file_handling
+import output_postprocess
+import evaluation_tool
+from onnx_inference import OnnxUNet
+
+ROIlist = ["BrachialPlexus","Brain","CochleaL","CochleaR","Larynx","ParotidL","ParotidR","SpinalCord",
+           "BrainStem","SubmandibularL","SubmandibularR"]
+
+ROInameconvert = {"BrachialPlexus":"Brachial Plexus","Brain":"Brain","CochleaL":"Cochlea L","CochleaR":"Cochlea R",
+                  "Larynx":"Larynx","ParotidL":"Parotid L","ParotidR":"Parotid R","SpinalCord":"Spinal Cord","BrainStem":"Brainstem",
+                  "SubmandibularL":"Submandibular L","SubmandibularR":"Submandibular R"}
+
+filters = {"bone":[2000, 400], "tissue":[400,40],"none":[4500,1000]} #same window/level filters as generate_dicom.py
+
+height_limits = {"BrainStem":27,"ParotidL":33,"ParotidR":33,"SubmandibularL":17,
+                 "SubmandibularR":17,"Larynx":18} #same limits as createdicomfile.create_dicom
+
+def roi_window(ROI):
+    if ROI in ("BrachialPlexus","SpinalCord"):
+        return "bone"
+    return "tissue"
+
+class CTCalibrationReader(CalibrationDataReader):
+    """
+    Feeds windowed CT slices to the ONNX Runtime calibrator in batches. Slices are
+    sampled evenly along z from every calibration patient so that the activation
+    ranges cover the whole head and neck, not just the slices containing the ROI.
+    """
+    def __init__(self,volumes,window,slices_per_patient=32,batch_size=8,inputname="input"):
+        samples = []
+        for volume in volumes:
+            indices = np.linspace(0,len(volume)-1,min(slices_per_patient,len(volume))).astype(int)
+            samples.append(file_handling.apply_window_level(volume[indices],filters[window][0],filters[window][1]))
+        self.samples = np.concatenate(samples,axis=0).astype(np.float32)
+        self.batch_size = batch_size
+        self.inputname = inputname
+        self.position = 0
+
+    def get_next(self):
+        if self.position >= len(self.samples):
+            return None
+        batch = self.samples[self.position:self.position+self.batch_size]
+        self.position += self.batch_size
+        return {self.inputname:batch}
+
+def load_volumes(patientfolders):
+    volumes = []
+    for folder in patientfolders:
+        filelist = file_handling.get_files(folder)
+        imagearray, heightlist = file_handling.build_array(filelist)
+        volumes.append(imagearray)
+    return volumes
+
+def quantize_models(calibrationfolders,ROIs=ROIlist,onnxfolder=os.path.join("weights","onnx"),
+                    int8folder=os.path.join("weights","onnx_int8"),slices_per_patient=32):
+    """
+    Parameters
+    ----------
+    calibrationfolders : list
+        Paths to patient folders of representative CT studies used for calibration.
+    ROIs : list, optional
+        ROIs to quantize. The default is every ROI.
+    onnxfolder : str, optional
+        Folder holding the float32 ONNX models.
+    int8folder : str, optional
+        Destination folder for the int8 models.
+    slices_per_patient : int, optional
+        Number of slices sampled from each calibration patient. The default is 32.
+    """
+    if not os.path.exists(int8folder):
+        os.makedirs(int8folder)
+    volumes = load_volumes(calibrationfolders)
+    for ROI in ROIs:
+        reader = CTCalibrationReader(volumes,roi_window(ROI),slices_per_patient)
+        quantize_static(os.path.join(onnxfolder,"%s.onnx" % ROI),
+                        os.path.join(int8folder,"%s.onnx" % ROI),
+                        reader,
+                        quant_format=QuantFormat.QOperator,
+                        per_channel=True,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8)
+        logger.info("Quantized %s.",ROI)
+
+def install_backend_models(int8folder=os.path.join("weights","onnx_int8"),
+                           backendfolder=os.path.join("..","backend","weights","onnx_int8"),ROIs=ROIlist):
+    #the backend names its models after oar_config.OARS without spaces, only BrainStem differs from the training names
+    if not os.path.exists(backendfolder):
+        os.makedirs(backendfolder)
+    for ROI in ROIs:
+        shutil.copyfile(os.path.join(int8folder,"%s.onnx" % ROI),
+                        os.path.join(backendfolder,"%s.onnx" % ROInameconvert[ROI].replace(" ","")))
+        logger.info("Installed %s for the backend.",ROI)
+
+def binarize(prediction,ROI,threshold=0.33):
+    #same post-processing chain as createdicomfile.create_dicom, so the metrics reflect the delivered contours
+    mask = output_postprocess.apply_threshold(np.squeeze(np.copy(prediction),axis=-1),threshold)
+    if np.sum(mask) == 0:
+        return mask
+    if ROI in height_limits:
+        mask = output_postprocess.height_prior(mask,height_limits[ROI])
+    mask = output_postprocess.scrap_stray(mask)
+    mask = output_postprocess.simple_z_smoothing(mask)
+    return mask
+
+def compare(volA,volB,bilateral,slicethickness):
+    #surface distances are undefined when either volume is empty
+    DSC = evaluation_tool.get_DSC(volA,volB)
+    if np.sum(volA) == 0 or np.sum(volB) == 0:
+        return DSC, np.nan, np.nan
+    MSD = evaluation_tool.mean_surface_distance(volA,volB,bilateral,slicethickness=slicethickness)
+    HD = evaluation_tool.hausdorff_distance(volA,volB,bilateral,slicethickness=slicethickness)
+    return DSC, MSD, HD
+
+def validate(validationfolders,ROIs=ROIlist,onnxfolder=os.path.join("weights","onnx"),
+             int8folder=os.path.join("weights","onnx_int8"),threshold=0.33):
+    """
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per ROI and patient. Columns DSC/MSD/HD compare int8 against float32
+        directly. Where ground truth is available, the *_delta columns hold the int8
+        metric minus the float32 metric, both scored against the ground truth.
+    """
+    float_model = OnnxUNet(onnxfolder)
+    int8_model = OnnxUNet(int8folder)
+    rows = []
+    for folder in validationfolders:
+        filelist, ss = file_handling.get_files(folder,get_rtstruct=True)
+        imagearray, heightlist = file_handling.build_array(filelist)
+        windows = file_handling.WindowCache(imagearray,filters)
+        slicethickness = float(np.min(np.diff(heightlist))) if len(heightlist) > 1 else 2.5
+        for ROI in ROIs:
+            bilateral = ROI == "BrachialPlexus"
+            model_input = windows.get(roi_window(ROI))
+            float_model.load_weights(ROI)
+            int8_model.load_weights(ROI)
+            float_mask = binarize(float_model.predict(model_input),ROI,threshold)
+            int8_mask = binarize(int8_model.predict(model_input),ROI,threshold)
+            DSC, MSD, HD = compare(float_mask,int8_mask,bilateral,slicethickness)
+            row = {"patient":os.path.basename(os.path.normpath(folder)),"ROI":ROI,"DSC":DSC,"MSD":MSD,"HD":HD}
+            if ss is not None:
+                valid, ref_num = file_handling.check_patient_validity(ss,[ROI,ROInameconvert[ROI]])
+                if valid:
+                    contourpoints = file_handling.get_contour_points(ss,ref_num)
+                    truemask = file_handling.build_mask(contourpoints,heightlist,256,1.0)
+                    float_metrics = compare(truemask,float_mask,bilateral,slicethickness)
+                    int8_metrics = compare(truemask,int8_mask,bilateral,slicethickness)
+                    for name,f,q in zip(("DSC","MSD","HD"),float_metrics,int8_metrics):
+                        row[name+"_float32"] = f
+                        row[name+"_int8"] = q
+                        row[name+"_delta"] = q - f
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level="INFO")
+    calibrationroot, validationroot = sys.argv[1], sys.argv[2]
+    calibrationfolders = [os.path.join(calibrationroot,item) for item in os.listdir(calibrationroot)
+                          if os.path.isdir(os.path.join(calibrationroot,item))]
+    validationfolders = [os.path.join(validationroot,item) for item in os.listdir(validationroot)
+                         if os.path.isdir(os.path.join(validationroot,item))]
+    quantize_models(calibrationfolders)
+    results = validate(validationfolders)
+    results.to_csv("quantization_validation.csv",index=False)
+    print(results.groupby("ROI").mean(numeric_only=True))
+    if len(sys.argv) > 3:
+        install_backend_models(backendfolder=sys.argv[3])
@@ -0,0 +1,6 @@
+import os
+import sys
+
+#training modules import each other as top-level modules, same as when the scripts are run from training/.
+#Appended rather than prepended: backend/ has modules of the same name (createdicomfile) that its tests need.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
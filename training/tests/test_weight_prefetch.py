@@ -0,0 +1,83 @@
+import threading
+
+import h5py
+import numpy as np
+import pytest
+
+import weight_prefetch
+
+class FakeModel:
+    def __init__(self):
+        self.reads = []
+        self.applied = []
+        self.read_threads = set()
+        self.release = {}
+
+    def read(self, ROI):
+        self.read_threads.add(threading.current_thread().name)
+        if ROI in self.release:
+            self.release[ROI].wait(5)
+        self.reads.append(ROI)
+        return ROI + ' weights'
+
+    def apply(self, weights):
+        self.applied.append(weights)
+
+def test_weights_are_applied_in_order_and_read_in_background():
+    model = FakeModel()
+    prefetcher = weight_prefetch.WeightPrefetcher(['Brainstem', 'Cochlea L', 'Cochlea R'], model.read, model.apply)
+    for ROI in ['Brainstem', 'Cochlea L', 'Cochlea R']:
+        prefetcher.load_weights(ROI)
+    prefetcher.close()
+    assert model.applied == ['Brainstem weights', 'Cochlea L weights', 'Cochlea R weights']
+    assert model.reads == ['Brainstem', 'Cochlea L', 'Cochlea R']
+    assert all(name.startswith('prefetch') for name in model.read_threads)
+
+def test_next_roi_is_read_before_it_is_requested():
+    model = FakeModel()
+    prefetcher = weight_prefetch.WeightPrefetcher(['Brainstem', 'Cochlea L'], model.read, model.apply)
+    prefetcher.load_weights('Brainstem')
+    prefetcher.futures['Cochlea L'].result(5)
+    assert model.reads == ['Brainstem', 'Cochlea L']
+    assert model.applied == ['Brainstem weights']
+    prefetcher.close()
+
+def test_load_waits_for_a_slow_read():
+    model = FakeModel()
+    model.release['Brainstem'] = threading.Event()
+    prefetcher = weight_prefetch.WeightPrefetcher(['Brainstem'], model.read, model.apply)
+    threading.Timer(0.1, model.release['Brainstem'].set).start()
+    prefetcher.load_weights('Brainstem')
+    assert model.applied == ['Brainstem weights']
+    prefetcher.close()
+
+def test_out_of_order_and_unknown_rois_are_read_on_demand():
+    model = FakeModel()
+    prefetcher = weight_prefetch.WeightPrefetcher(['Brainstem', 'Cochlea L'], model.read, model.apply)
+    prefetcher.load_weights('Cochlea L')
+    prefetcher.load_weights('Larynx')
+    prefetcher.load_weights('Brainstem')
+    prefetcher.close()
+    assert model.applied == ['Cochlea L weights', 'Larynx weights', 'Brainstem weights']
+
+def test_read_errors_reach_the_caller():
+    def read(ROI):
+        raise OSError('missing weights')
+    prefetcher = weight_prefetch.WeightPrefetcher(['Brainstem'], read, lambda weights: None)
+    with pytest.raises(OSError):
+        prefetcher.load_weights('Brainstem')
+    prefetcher.close()
+
+def test_read_hdf5_weights(tmp_path):
+    filepath = str(tmp_path / 'Brainstem.hdf5')
+    kernel, bias = np.ones((3, 3, 1, 2), dtype=np.float32), np.zeros(2, dtype=np.float32)
+    with h5py.File(filepath, 'w') as f:
+        f.attrs['layer_names'] = [b'input', b'conv']
+        f.create_group('input').attrs['weight_names'] = []
+        conv = f.create_group('conv')
+        conv.attrs['weight_names'] = [b'conv/kernel:0', b'conv/bias:0']
+        conv['conv/kernel:0'] = kernel
+        conv['conv/bias:0'] = bias
+    weights = weight_prefetch.read_hdf5_weights(filepath)
+    assert len(weights) == 1
+    assert np.array_equal(weights[0][0], kernel) and np.array_equal(weights[0][1], bias)
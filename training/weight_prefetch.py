@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Background prefetching of per-ROI weights.
+
+The OAR loop in generate_dicom.py used to call load_weights right before each
+predict, so every ROI waited for its HDF5 file to be read and deserialized.
+WeightPrefetcher reads the next ROI's weights on a background thread while the
+current ROI is being predicted, and only the swap into the model (in-memory
+arrays) is left on the critical path.
+
+Keras weights are read straight from the HDF5 file with h5py into numpy arrays
+(same file layout Keras' save_weights writes) and set layer by layer, so the
+model is never touched from the background thread.
+"""
+import threading
+import logging
+logger = logging.getLogger(name="WeightPrefetch")
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+def _decode(names):
+    return [name.decode("utf8") if isinstance(name, bytes) else name for name in names]
+
+def read_hdf5_weights(filepath):
+    """
+    Returns the weights stored in a Keras HDF5 file as a list with one entry per
+    layer that has weights, each a list of numpy arrays, in file (layer) order.
+    """
+    with h5py.File(filepath, "r") as f:
+        group = f["model_weights"] if "model_weights" in f else f #whole-model saves keep the weights in a subgroup
+        weights = []
+        for layer_name in _decode(group.attrs["layer_names"]):
+            layer_group = group[layer_name]
+            arrays = [np.asarray(layer_group[name]) for name in _decode(layer_group.attrs["weight_names"])]
+            if len(arrays) > 0:
+                weights.append(arrays)
+    return weights
+
+def set_layer_weights(model, weights):
+    #same matching as Keras' own HDF5 loader: the n-th layer with weights gets the n-th weight group
+    layers = [layer for layer in model.layers if len(layer.weights) > 0]
+    if len(layers) != len(weights):
+        raise ValueError("Weight file holds %d layers but the model has %d layers with weights." % (len(weights), len(layers)))
+    for layer, arrays in zip(layers, weights):
+        layer.set_weights(arrays)
+
+class WeightPrefetcher:
+    def __init__(self, ROIs, read, apply):
+        """
+        Parameters
+        ----------
+        ROIs : list
+            ROIs in the order they will be loaded. The first one is read immediately.
+        read : callable
+            read(ROI) loads and deserializes the ROI's weights, runs on the background thread.
+        apply : callable
+            apply(weights) swaps the result of read into the model, runs on the caller's thread.
+        """
+        self.ROIs = list(ROIs)
+        self.read = read
+        self.apply = apply
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.futures = {}
+        self.lock = threading.Lock()
+        if len(self.ROIs) > 0:
+            self.prefetch(self.ROIs[0])
+
+    def prefetch(self, ROI):
+        with self.lock:
+            if ROI not in self.futures:
+                self.futures[ROI] = self.executor.submit(self.read, ROI)
+
+    def load_weights(self, ROI):
+        """
+        Waits for ROI's weights (normally already read), swaps them into the model and
+        starts reading the ROI that follows it.
+        """
+        self.prefetch(ROI) #not prefetched if ROIs are loaded out of order
+        with self.lock:
+            future = self.futures.pop(ROI)
+        if not future.done():
+            logger.info("Waiting for %s weights.", ROI)
+        weights = future.result()
+        position = self.ROIs.index(ROI) if ROI in self.ROIs else -1
+        if 0 <= position < len(self.ROIs) - 1:
+            self.prefetch(self.ROIs[position + 1]) #read during this ROI's predict
+        self.apply(weights)
+
+    def close(self):
+        self.executor.shutdown(wait=False)